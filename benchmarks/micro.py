@@ -0,0 +1,142 @@
+"""
+Microbenchmarks of the hot helpers every request goes through, without
+any I/O.
+
+    python -m benchmarks.micro
+"""
+import gzip
+import json
+import sys
+import timeit
+
+import orjson
+from pydantic import TypeAdapter
+
+from resources.get_all_groups import GetGroupResponse as GroupSummary
+from resources.get_all_groups import PaginatedGroupsResponse
+from resources.get_group_from_id import GetGroupResponse
+from services.compression import GZIP_LEVEL
+from services.cursors import decode_cursor, encode_cursor
+from services.query_builder import build_insert_many, build_select
+from services.response_cache import make_etag
+from services.rows import map_rows
+from services.ttl_cache import TTLCache
+
+
+# a page of GET /groups with this many groups of 8 members
+PAGE_SIZE = 1000
+
+
+def _page_rows():
+    return [
+        {
+            "group_id": i,
+            "name": f"Group {i}",
+            "group_photo": f"https://example.com/{i}.png",
+            "member_count": 8,
+            "members": [f"user{i * 8 + j}@example.com" for j in range(8)],
+            "links": [
+                {"rel": "self", "href": f"groups/{i}"},
+                {"rel": "members", "href": f"groups/{i}/members"},
+                {"rel": "expenses", "href": f"groups/{i}/expenses"},
+            ],
+        }
+        for i in range(PAGE_SIZE)
+    ]
+
+
+def _page_links():
+    return [{"rel": "current", "href": f"groups?limit={PAGE_SIZE}&offset=0"}]
+
+
+_page_adapter = TypeAdapter(PaginatedGroupsResponse)
+
+
+def page_with_models(rows):
+    """
+    How GET /groups used to answer: a model per group, validated again
+    against the response model and encoded with the json module.
+    """
+    response = PaginatedGroupsResponse(
+        data=[GroupSummary(**row) for row in rows],
+        links=_page_links(),
+        total_count=None,
+    )
+    content = _page_adapter.dump_python(
+        _page_adapter.validate_python(response, from_attributes=True), mode="json"
+    )
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode()
+
+
+def page_with_orjson(rows):
+    """
+    How it answers now: plain dicts, encoded with orjson.
+    """
+    data = [dict(row) for row in rows]
+    return orjson.dumps({"data": data, "links": _page_links(), "total_count": None})
+
+
+def _cases():
+    ids = list(range(50))
+    rows = [(i, f"Group {i}", f"https://example.com/{i}.png", 8) for i in range(1000)]
+    members = [{"group_id": 1, "user_id": str(i)} for i in range(50)]
+    cache = TTLCache(max_size=10000, ttl=60)
+    for i in range(10000):
+        cache.set(i, i)
+    response = GetGroupResponse(
+        group_id=1,
+        name="Group 1",
+        group_photo="https://example.com/1.png",
+        member_count=20,
+        members=[f"User {i}" for i in range(20)],
+        labels=[],
+        links=[{"rel": "self", "href": "/api/groups/1"}] * 3,
+    )
+    body = response.model_dump_json().encode()
+    cursor = encode_cursor(12345)
+    page = _page_rows()
+    page_body = page_with_orjson(page)
+
+    return {
+        "build_select (by id)": lambda: build_select(
+            "group_service_db", "groups", {"group_id": 1}
+        ),
+        "build_select (IN 50)": lambda: build_select(
+            "group_service_db", "groups", {"group_id": ids}
+        ),
+        "build_insert_many (50)": lambda: build_insert_many(
+            "group_service_db", "group_members", members
+        ),
+        "map_rows (1000 rows)": lambda: map_rows(
+            "group_service_db", "groups", None, rows
+        ),
+        "TTLCache.get": lambda: cache.get(5000),
+        "encode_cursor": lambda: encode_cursor(12345),
+        "decode_cursor": lambda: decode_cursor(cursor),
+        "GetGroupResponse json": response.model_dump_json,
+        "make_etag": lambda: make_etag(body),
+        f"page of {PAGE_SIZE}, models+json": lambda: page_with_models(page),
+        f"page of {PAGE_SIZE}, dicts+orjson": lambda: page_with_orjson(page),
+        f"page of {PAGE_SIZE}, gzip": lambda: gzip.compress(page_body, GZIP_LEVEL),
+    }
+
+
+def main():
+    page = _page_rows()
+    print(
+        f"page of {PAGE_SIZE} groups: {len(page_with_models(page))} bytes, "
+        f"{len(gzip.compress(page_with_orjson(page), GZIP_LEVEL))} gzipped\n"
+    )
+    print(f"{'case':<28} {'per call':>12}")
+    for name, func in _cases().items():
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=5, number=number)) / number
+        print(f"{name:<28} {best * 1e6:>9.2f} us")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
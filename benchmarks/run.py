@@ -0,0 +1,414 @@
+"""
+Load test of every GroupService endpoint.
+
+Seeds a database and a local storage directory, then drives `main.app`
+in-process with concurrent clients and reports, per endpoint, the
+throughput, the p50/p95/p99 latency and the database queries per request
+(from the Server-Timing header).
+
+    python -m benchmarks.run                        # SQLite stand-in
+    python -m benchmarks.run --save-baseline        # record a baseline
+    python -m benchmarks.run --compare              # fail on regressions
+
+With `--database mysql` it runs against a MySQL server of its own,
+configured by the BENCHMARK_DATABASE_IP, _PORT, _UNAME and _PWORD
+variables; the service's DATABASE_* variables (and .env) are never used
+for it. Its tables are created if needed and EMPTIED before seeding, so
+never point it at a real database.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+_QUERIES = re.compile(r'desc="(\d+) queries"')
+
+# what a sidebar listing groups asks for
+SUMMARY_FIELDS = "name,group_photo,member_count"
+# groups per POST /groups:batchDelete
+BATCH_DELETE_SIZE = 2
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database", choices=["sqlite", "mysql"], default="sqlite")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--groups", type=int, default=2000)
+    parser.add_argument("--members", type=int, default=8, help="members per group")
+    parser.add_argument("--photos", type=int, default=50, help="groups with a photo")
+    parser.add_argument("--requests", type=int, default=500, help="per endpoint")
+    parser.add_argument("--warmup", type=int, default=20, help="per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--only", action="append", help="run only these endpoints (repeatable)"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--save-baseline",
+        nargs="?",
+        const=DEFAULT_BASELINE,
+        metavar="PATH",
+        help=f"save the results as the baseline (default {DEFAULT_BASELINE})",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs="?",
+        const=DEFAULT_BASELINE,
+        metavar="PATH",
+        help="compare with a saved baseline, exit 1 on a regression",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative p95 slowdown before it counts as a regression",
+    )
+    return parser.parse_args(argv)
+
+
+# The benchmark server's settings, copied over the service's own.
+BENCHMARK_DATABASE_VARIABLES = {
+    "BENCHMARK_DATABASE_IP": "DATABASE_IP",
+    "BENCHMARK_DATABASE_PORT": "DATABASE_PORT",
+    "BENCHMARK_DATABASE_UNAME": "DATABASE_UNAME",
+    "BENCHMARK_DATABASE_PWORD": "DATABASE_PWORD",
+}
+
+
+def configure_database(database):
+    """
+    Points the service at the benchmark's MySQL server, or exits if none
+    is configured: the run empties the tables of the server it uses.
+    """
+    if database != "mysql":
+        return
+
+    missing = [
+        name
+        for name in ("BENCHMARK_DATABASE_IP", "BENCHMARK_DATABASE_UNAME")
+        if not os.getenv(name)
+    ]
+    if missing:
+        sys.exit(
+            f"--database mysql empties the tables of the server it runs on, set "
+            f"{' and '.join(missing)} to a server for benchmarks only"
+        )
+
+    os.environ.setdefault("BENCHMARK_DATABASE_PORT", "3306")
+    os.environ.setdefault("BENCHMARK_DATABASE_PWORD", "")
+    # set before the service modules load .env, which doesn't override
+    for name, service_name in BENCHMARK_DATABASE_VARIABLES.items():
+        os.environ[service_name] = os.environ[name]
+    # every read goes to the benchmark server
+    os.environ.pop("DATABASE_REPLICAS", None)
+
+
+def configure_environment(workdir):
+    # has to happen before the service modules are imported, they read
+    # their configuration at import time
+    os.environ["STORAGE_ROOT"] = os.path.join(workdir, "storage")
+    os.environ["PHOTO_CACHE_DIR"] = os.path.join(workdir, "photo-cache")
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    os.environ.setdefault("ACCESS_LOG_SAMPLE_RATE", "0")
+    os.environ.setdefault("QUERY_BUDGET", "0")
+    os.environ.setdefault("GROUP_ASYNC_MEMBER_THRESHOLD", "1000000")
+    os.environ.pop("CACHE_URL", None)
+    # the schema is set up before seeding, see main()
+    os.environ["MIGRATE_ON_STARTUP"] = "0"
+
+
+class Scenario:
+    """
+    One endpoint under load. `request(client, rng)` sends one request.
+    """
+
+    def __init__(self, name, request, expected=(200,)):
+        self.name = name
+        self.request = request
+        self.expected = expected
+
+
+def build_scenarios(args):
+    """
+    The scenarios of every endpoint, except GET /metrics and GET /, which
+    serve monitoring and no client.
+    """
+    from benchmarks.seed import JOBS, job_id, photo_png, user_email
+
+    # gets read the lower half of the groups, deletes consume the upper one
+    # and the groups POST /groups created
+    readable = range(1, args.groups // 2 + 1)
+    deletable = list(range(args.groups // 2 + 1, args.groups + 1))
+    created = []
+    photo_ids = range(1, min(args.photos, len(readable)) + 1)
+    job_numbers = range(1, min(JOBS, args.groups) + 1)
+    photo = photo_png()
+
+    def random_user(rng):
+        return rng.randint(1, args.users)
+
+    async def list_groups(client, rng):
+        return await client.get(f"/groups?user_id={random_user(rng)}&limit=10")
+
+    async def list_groups_total(client, rng):
+        return await client.get(
+            f"/groups?user_id={random_user(rng)}&limit=10&include_total=true"
+        )
+
+    async def list_groups_summary(client, rng):
+        return await client.get(
+            f"/groups?user_id={random_user(rng)}&limit=10&fields={SUMMARY_FIELDS}"
+        )
+
+    async def get_group(client, rng):
+        return await client.get(f"/groups/{rng.choice(readable)}")
+
+    async def get_group_summary(client, rng):
+        return await client.get(
+            f"/groups/{rng.choice(readable)}?fields={SUMMARY_FIELDS}"
+        )
+
+    async def get_group_members(client, rng):
+        return await client.get(f"/groups/{rng.choice(readable)}/members")
+
+    async def batch_get(client, rng):
+        ids = rng.sample(readable, min(20, len(readable)))
+        return await client.post("/groups:batchGet", json={"group_ids": ids})
+
+    async def get_photo(client, rng):
+        return await client.get(
+            f"/groups/{rng.choice(photo_ids)}/photo?size=thumb",
+            headers={"Accept": "image/webp"},
+        )
+
+    async def upload_photo(client, rng):
+        return await client.post(
+            "/upload-photo", files={"file": ("benchmark.png", photo, "image/png")}
+        )
+
+    async def get_job(client, rng):
+        return await client.get(f"/jobs/{job_id(rng.choice(job_numbers))}")
+
+    async def create_group(client, rng):
+        members = [user_email(random_user(rng)) for _ in range(args.members)]
+        response = await client.post(
+            "/groups", json={"name": "Benchmark group", "members": members}
+        )
+        if response.status_code == 201:
+            created.append(response.json()["group_id"])
+        return response
+
+    async def delete_group(client, rng):
+        return await client.delete(f"/groups/{deletable.pop()}")
+
+    async def batch_delete(client, rng):
+        ids = [(created or deletable).pop() for _ in range(BATCH_DELETE_SIZE)]
+        return await client.post("/groups:batchDelete", json={"group_ids": ids})
+
+    scenarios = [
+        Scenario("GET /groups", list_groups),
+        Scenario("GET /groups?include_total", list_groups_total),
+        Scenario("GET /groups?fields", list_groups_summary),
+        Scenario("GET /groups/{id}", get_group),
+        Scenario("GET /groups/{id}?fields", get_group_summary),
+        Scenario("GET /groups/{id}/members", get_group_members),
+        Scenario("POST /groups:batchGet", batch_get),
+        Scenario("GET /jobs/{id}", get_job),
+        Scenario("POST /upload-photo", upload_photo),
+        Scenario("POST /groups", create_group, expected=(201,)),
+        # last, they remove groups
+        Scenario("DELETE /groups/{id}", delete_group, expected=(204,)),
+        Scenario("POST /groups:batchDelete", batch_delete),
+    ]
+    if args.photos:
+        scenarios.insert(7, Scenario("GET /groups/{id}/photo", get_photo))
+
+    if args.only:
+        scenarios = [s for s in scenarios if s.name in args.only]
+    return scenarios
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run_scenario(client, scenario, requests, concurrency, rng):
+    latencies = []
+    queries = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            response = await scenario.request(client, rng)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code not in scenario.expected:
+                errors += 1
+            match = _QUERIES.search(response.headers.get("server-timing", ""))
+            if match:
+                queries.append(int(match.group(1)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "queries": round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+async def run(args):
+    import httpx
+
+    import main
+
+    scenarios = build_scenarios(args)
+    rng = random.Random(args.seed)
+    results = {}
+
+    # a failing request counts as an error instead of stopping the run
+    transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark"
+        ) as client:
+            for scenario in scenarios:
+                if args.warmup and not scenario.name.startswith(("POST", "DELETE")):
+                    await run_scenario(
+                        client, scenario, args.warmup, args.concurrency, rng
+                    )
+                results[scenario.name] = await run_scenario(
+                    client, scenario, args.requests, args.concurrency, rng
+                )
+                print_result(scenario.name, results[scenario.name])
+
+    return results
+
+
+def print_header():
+    print(
+        f"{'endpoint':<28} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} "
+        f"{'p99 ms':>9} {'queries':>8} {'errors':>7}"
+    )
+
+
+def print_result(name, result):
+    queries = "-" if result["queries"] is None else f"{result['queries']:.1f}"
+    print(
+        f"{name:<28} {result['rps']:>9.1f} {result['p50_ms']:>9.2f} "
+        f"{result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {queries:>8} "
+        f"{result['errors']:>7}"
+    )
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the regressions of `results` against `baseline`: a p95 more
+    than `tolerance` slower, or more queries per request.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {before['p95_ms']:.2f} ms -> {result['p95_ms']:.2f} ms"
+            )
+        if (
+            result["queries"] is not None
+            and before.get("queries") is not None
+            and result["queries"] > before["queries"]
+        ):
+            regressions.append(
+                f"{name}: queries per request {before['queries']} -> {result['queries']}"
+            )
+        if result["errors"] > before.get("errors", 0):
+            regressions.append(f"{name}: {result['errors']} unexpected responses")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.requests * BATCH_DELETE_SIZE > args.groups // 2:
+        sys.exit(
+            f"--requests can be at most 1/{2 * BATCH_DELETE_SIZE} of --groups, "
+            "deletes use them up"
+        )
+    configure_database(args.database)
+    workdir = tempfile.mkdtemp(prefix="group-service-benchmark-")
+    configure_environment(workdir)
+
+    from benchmarks import seed, stand_in
+    from services.sql_comands import SQLMachine
+    from services.storage import get_storage
+
+    if args.database == "sqlite":
+        stand_in.install()
+    else:
+        seed.create_mysql_schema(SQLMachine())
+
+    print(
+        f"Seeding {args.users} users, {args.groups} groups of {args.members} "
+        f"members and {args.photos} photos ({args.database})"
+    )
+    seed.seed(
+        args.users, args.groups, args.members, args.photos, get_storage(), args.seed
+    )
+
+    print(f"{args.requests} requests per endpoint, {args.concurrency} concurrent\n")
+    print_header()
+    results = asyncio.run(run(args))
+
+    meta = {
+        "database": args.database,
+        "users": args.users,
+        "groups": args.groups,
+        "members": args.members,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+    }
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("meta") != meta:
+            print(f"\nWarning: the baseline was recorded with {baseline.get('meta')}")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo regressions against the baseline")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+"""
+Fills the database and the storage with generated users, groups,
+memberships and group photos for the benchmarks.
+"""
+import os
+import random
+from io import BytesIO
+
+from PIL import Image
+
+from services.images import process_image, variant_name
+from services.migrations import migrate
+from services.sql_comands import SQLMachine
+from services.storage import group_photo_name
+
+# The tables on a real MySQL server the service doesn't create itself,
+# used with --database mysql. The group_service_db tables come from the
+# service's migrations.
+MYSQL_SCHEMA = [
+    "CREATE DATABASE IF NOT EXISTS group_service_db",
+    "CREATE DATABASE IF NOT EXISTS user_service_db",
+    """
+    CREATE TABLE IF NOT EXISTS user_service_db.users (
+        id VARCHAR(64) NOT NULL PRIMARY KEY,
+        email VARCHAR(255) NOT NULL UNIQUE,
+        name VARCHAR(255) NOT NULL,
+        currency_preference VARCHAR(8) NOT NULL,
+        profile_pic VARCHAR(1024) NOT NULL
+    )
+    """,
+]
+
+MYSQL_TRUNCATE = [
+    "TRUNCATE TABLE group_service_db.group_members",
+    "TRUNCATE TABLE group_service_db.groups",
+    "TRUNCATE TABLE group_service_db.jobs",
+    "TRUNCATE TABLE user_service_db.users",
+]
+
+BATCH_SIZE = 1000
+# finished group creation jobs, for polling their status
+JOBS = 100
+
+
+def user_email(user_id):
+    return f"user{user_id}@example.com"
+
+
+def job_id(n):
+    return f"{n:032x}"
+
+
+def _insert(sql, schema, table, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        sql.insert_many(schema, table, rows[start:start + BATCH_SIZE])
+
+
+def create_mysql_schema(sql):
+    """
+    Creates the tables on a MySQL server and empties them.
+
+    Refuses to unless the service was pointed at the benchmark's own
+    server (BENCHMARK_DATABASE_IP, see benchmarks/run.py).
+    """
+    benchmark_ip = os.getenv("BENCHMARK_DATABASE_IP")
+    if not benchmark_ip or os.getenv("DATABASE_IP") != benchmark_ip:
+        raise RuntimeError(
+            "Not emptying the tables of a server that isn't "
+            "BENCHMARK_DATABASE_IP, see benchmarks/run.py"
+        )
+
+    for statement in MYSQL_SCHEMA:
+        sql.execute(statement)
+    migrate()
+    for statement in MYSQL_TRUNCATE:
+        sql.execute(statement)
+
+
+def photo_png():
+    """
+    A generated 800x600 PNG, the photo of every seeded group and what the
+    upload benchmark sends.
+    """
+    image = Image.effect_mandelbrot((800, 600), (-2.0, -1.2, 1.0, 1.2), 64)
+    out = BytesIO()
+    image.convert("RGB").save(out, format="PNG")
+    return out.getvalue()
+
+
+def seed(users, groups, members_per_group, photos, storage, seed=0):
+    """
+    Creates `users` users and `groups` groups of `members_per_group`
+    random members each. The first `photos` groups get a photo (with its
+    size variants) in `storage`. The creation of the first JOBS groups is
+    recorded as finished jobs.
+
+    Group ids are 1..groups, user ids "1".."users" and job ids job_id(1)..
+    """
+    rng = random.Random(seed)
+    sql = SQLMachine()
+
+    _insert(
+        sql,
+        "user_service_db",
+        "users",
+        [
+            {
+                "id": str(user_id),
+                "email": user_email(user_id),
+                "name": f"User {user_id}",
+                "currency_preference": rng.choice(["USD", "EUR", "GBP"]),
+                "profile_pic": f"https://example.com/users/{user_id}.png",
+            }
+            for user_id in range(1, users + 1)
+        ],
+    )
+
+    group_rows = []
+    for group_id in range(1, groups + 1):
+        photo = None
+        if group_id <= photos:
+            photo = storage.public_url(group_photo_name(group_id))
+        group_rows.append(
+            {
+                "group_id": group_id,
+                "group_name": f"Group {group_id}",
+                "group_photo": photo,
+                "member_count": min(members_per_group, users),
+            }
+        )
+    _insert(sql, "group_service_db", "groups", group_rows)
+
+    member_rows = []
+    for group_id in range(1, groups + 1):
+        for user_id in rng.sample(range(1, users + 1), min(members_per_group, users)):
+            member_rows.append({"group_id": group_id, "user_id": str(user_id)})
+    _insert(sql, "group_service_db", "group_members", member_rows)
+
+    _insert(
+        sql,
+        "group_service_db",
+        "jobs",
+        [
+            {
+                "job_id": job_id(n),
+                "kind": "create_group",
+                "status": "succeeded",
+                "payload": "{}",
+                "result": f'{{"group_id": {n}}}',
+                "attempts": 1,
+            }
+            for n in range(1, min(JOBS, groups) + 1)
+        ],
+    )
+
+    if photos:
+        variants = process_image(photo_png())
+        for group_id in range(1, photos + 1):
+            name = group_photo_name(group_id)
+            for variant, data in variants.items():
+                storage.upload(variant_name(name, variant), BytesIO(data))
@@ -0,0 +1,173 @@
+"""
+A stand-in for the MySQL server, so the service can be benchmarked
+without one: every connection of SQLMachine and AsyncSQLMachine goes to
+one in-memory SQLite database holding the same schemas and tables (as
+they are after services/migrations.py).
+
+It measures the service's own overhead (routing, query building, row
+mapping, caching, serialization), not MySQL. Transactions aren't
+isolated on the stand-in; run against a real MySQL server (see
+`python -m benchmarks.run --help`) for numbers that include the
+database.
+"""
+import sqlite3
+import threading
+
+from services.async_sql_comands import AsyncSQLMachine
+from services.sql_comands import SQLMachine
+
+SQLITE_SCHEMA = """
+CREATE TABLE group_service_db.groups (
+    group_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    group_name TEXT NOT NULL,
+    group_photo TEXT,
+    member_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE group_service_db.group_members (
+    group_id INTEGER NOT NULL,
+    user_id TEXT NOT NULL
+);
+CREATE UNIQUE INDEX group_service_db.group_members_group_user
+    ON group_members (group_id, user_id);
+CREATE INDEX group_service_db.group_members_user_group
+    ON group_members (user_id, group_id);
+CREATE TABLE group_service_db.jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE TABLE user_service_db.users (
+    id TEXT PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE COLLATE NOCASE,
+    name TEXT NOT NULL,
+    currency_preference TEXT NOT NULL,
+    profile_pic TEXT NOT NULL
+);
+"""
+
+
+class _Database:
+    def __init__(self):
+        self.connection = sqlite3.connect(
+            ":memory:", check_same_thread=False, isolation_level=None
+        )
+        self.connection.execute("ATTACH ':memory:' AS group_service_db")
+        self.connection.execute("ATTACH ':memory:' AS user_service_db")
+        self.connection.executescript(SQLITE_SCHEMA)
+        # the sync pool's threads share the one connection
+        self.lock = threading.Lock()
+
+    def execute(self, query, values):
+        # the MySQL tables of the service's migrations already exist here
+        if query.lstrip().upper().startswith("CREATE"):
+            return None
+        with self.lock:
+            return self.connection.execute(query.replace("%s", "?"), tuple(values))
+
+
+class _Cursor:
+    def __init__(self, database):
+        self._database = database
+        self._cursor = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self, query, values=()):
+        self._cursor = self._database.execute(query, values)
+        if self._cursor is not None:
+            self.rowcount = self._cursor.rowcount
+            self.lastrowid = self._cursor.lastrowid
+
+    def fetchall(self):
+        return tuple(self._cursor.fetchall()) if self._cursor else ()
+
+    def fetchone(self):
+        return self._cursor.fetchone() if self._cursor else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class _Connection:
+    def __init__(self, database):
+        self._database = database
+
+    def cursor(self):
+        return _Cursor(self._database)
+
+    def ping(self, reconnect=False):
+        pass
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _AsyncCursor(_Cursor):
+    async def execute(self, query, values=()):
+        _Cursor.execute(self, query, values)
+
+    async def fetchall(self):
+        return _Cursor.fetchall(self)
+
+    async def fetchone(self):
+        return _Cursor.fetchone(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class _AsyncConnection(_Connection):
+    def cursor(self):
+        return _AsyncCursor(self._database)
+
+    async def ping(self, reconnect=False):
+        pass
+
+    async def begin(self):
+        pass
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
+def install():
+    """
+    Points SQLMachine and AsyncSQLMachine at a fresh stand-in database.
+    Call it before the first query.
+    """
+    database = _Database()
+
+    # read replicas get the same database
+    async def create_async_connection(host=None, port=None):
+        return _AsyncConnection(database)
+
+    SQLMachine.create_connection = staticmethod(
+        lambda host=None, port=None: _Connection(database)
+    )
+    AsyncSQLMachine.create_connection = staticmethod(create_async_connection)
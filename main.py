@@ -1,7 +1,8 @@
-import logging
+import asyncio
 import time
 import uvicorn
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
@@ -11,35 +12,94 @@ from resources import (
     get_all_groups,
     delete_group,
     get_group_members,
+    batch_get_groups,
+    get_job,
+    metrics,
 )
+from services.async_sql_comands import close_async_pool
+from services.cache_backend import close_cache
+from services.compression import JSONGZipMiddleware
+from services.storage import shutdown_storage
+from services.images import shutdown_images
+from services.jobs import start_jobs, close_job_queue
+from services.migrations import MIGRATE_ON_STARTUP, migrate
+from services.metrics import (
+    REQUESTS_IN_PROGRESS,
+    observe_request,
+    route_label,
+)
+from services.query_tracker import track_queries
+from services.replicas import read_your_writes
+from services.access_log import (
+    REQUEST_ID_HEADER,
+    end_request,
+    log_access,
+    setup_logging,
+    start_request,
+    stop_logging,
+)
+
+# write every log line as JSON from a background thread
+setup_logging()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup_logging()
+    # bring the database schema up to date before serving anything
+    if MIGRATE_ON_STARTUP:
+        await asyncio.to_thread(migrate)
+    # pick up the background jobs a previous run left unfinished
+    await start_jobs()
+    yield
+    # stop the job workers, then close the pooled database connections,
+    # the cache and the storage and image workers on shutdown
+    await close_job_queue()
+    await close_async_pool()
+    await close_cache()
+    shutdown_storage()
+    shutdown_images()
+    stop_logging()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(create_group.router)
 app.include_router(get_group_from_id.router)
 app.include_router(get_all_groups.router)
 app.include_router(delete_group.router)
 app.include_router(get_group_members.router)
+app.include_router(batch_get_groups.router)
+app.include_router(get_job.router)
+app.include_router(metrics.router)
 
-# set up middleware logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
+# gzip big JSON responses, inside the request logging so it is timed
+app.add_middleware(JSONGZipMiddleware)
 
-# middleware to log requests before and after
+# middleware to log, time and count every request
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    logger.info(f"Request: {request.method} {request.url}")
-
-    # log before the request is processed
-    start_time = time.time()
-
-    # call the next process in the pipeline
-    response = await call_next(request)
-
-    # log after the request is processed
-    process_time = time.time() - start_time
-    logger.info(f"Response status: {response.status_code} | Time: {process_time:.4f}s")
+    start_time = time.perf_counter()
+    status_code = 500
+    request_id, token = start_request(request.headers.get(REQUEST_ID_HEADER))
+
+    # call the next process in the pipeline, counting its queries
+    REQUESTS_IN_PROGRESS.inc()
+    try:
+        with track_queries() as tracker, read_your_writes():
+            response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        REQUESTS_IN_PROGRESS.dec()
+        process_time = time.perf_counter() - start_time
+        route = route_label(request.scope)
+        observe_request(request.method, route, status_code, process_time)
+        log_access(request, status_code, process_time, route, tracker)
+        tracker.report(f"{request.method} {route}")
+        end_request(token)
+
+    response.headers["Server-Timing"] = tracker.server_timing(process_time)
+    response.headers[REQUEST_ID_HEADER] = request_id
 
     return response
 
@@ -67,4 +127,5 @@ def get_root():
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=4001)
+    # every request is logged by log_access already, sampled
+    uvicorn.run(app, host="0.0.0.0", port=4001, access_log=False)
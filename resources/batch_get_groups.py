@@ -0,0 +1,84 @@
+import os
+
+from fastapi import APIRouter, HTTPException
+from services.async_sql_comands import AsyncSQLMachine
+from services import users
+from resources.get_group_from_id import GetGroupResponse, make_group_response
+from pydantic import BaseModel
+from typing import List
+
+router = APIRouter()
+
+# Most groups a single batch request may ask for.
+GROUP_BATCH_MAX_SIZE = int(os.getenv("GROUP_BATCH_MAX_SIZE", "100"))
+
+
+# request model
+class BatchGetGroupsRequest(BaseModel):
+    group_ids: List[int]
+
+
+# response model
+class BatchGetGroupsResponse(BaseModel):
+    groups: List[GetGroupResponse]  # in the order they were asked for
+    not_found: List[int]
+
+
+@router.post(
+    "/groups:batchGet",
+    response_model=BatchGetGroupsResponse,
+    status_code=200,
+    summary="Get many groups by their GroupIDs",
+    description="Retrieve detailed information about several groups at once. "
+    "Every group is returned like by `GET /groups/{group_id}`; unknown IDs "
+    f"are listed in `not_found`. At most {GROUP_BATCH_MAX_SIZE} IDs per request.",
+    responses={
+        400: {"description": "Bad Request - Too many group IDs in one request"},
+    },
+)
+async def batch_get_groups(request: BatchGetGroupsRequest):
+    # drop duplicates, keeping the order of the request
+    group_ids = list(dict.fromkeys(request.group_ids))
+    if len(group_ids) > GROUP_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {GROUP_BATCH_MAX_SIZE} groups can be fetched at once",
+        )
+    if not group_ids:
+        return BatchGetGroupsResponse(groups=[], not_found=[])
+
+    sql = AsyncSQLMachine()
+
+    # Step 1: Fetch every group at once
+    group_rows = await sql.select(
+        "group_service_db", "groups", {"group_id": group_ids}
+    )
+    group_details = {group.group_id: group for group in group_rows}
+
+    # Step 2: Fetch the memberships of every group at once
+    group_members = await sql.select(
+        "group_service_db", "group_members", {"group_id": list(group_details)}
+    )
+    member_user_ids = {}
+    for member in group_members:
+        member_user_ids.setdefault(member.group_id, []).append(member.user_id)
+
+    # Step 3: Fetch the names of every member at once
+    user_ids = {uid for uids in member_user_ids.values() for uid in uids}
+    member_users = await users.get_users(user_ids)
+
+    groups = []
+    not_found = []
+    for group_id in group_ids:
+        if group_id not in group_details:
+            not_found.append(group_id)
+            continue
+
+        members = [
+            member_users[uid].name
+            for uid in member_user_ids.get(group_id, [])
+            if uid in member_users
+        ]
+        groups.append(make_group_response(group_details[group_id], members))
+
+    return BatchGetGroupsResponse(groups=groups, not_found=not_found)
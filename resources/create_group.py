@@ -1,11 +1,57 @@
-from fastapi import APIRouter, HTTPException, Response, UploadFile, Form
-from services.sql_comands import SQLMachine
+import asyncio
+import json
+import logging
+import os
+from io import BytesIO
+
+from fastapi import (
+    APIRouter,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    Form,
+)
+from fastapi.responses import JSONResponse
+from starlette.datastructures import UploadFile
+from services.async_sql_comands import AsyncSQLMachine
+from services import users
+from services.response_cache import invalidate_group
+from services.jobs import (
+    PermanentJobError,
+    QueueFull,
+    current_job_id,
+    get_job,
+    get_job_queue,
+    job_handler,
+)
+from services.storage import (
+    get_storage,
+    group_photo_name,
+    object_name,
+    run_in_storage_pool,
+)
+from services.streaming import ranged_response
+from services.photo_cache import fetch_photo, get_photo_cache, iter_file_range
+from services.images import (
+    MAX_UPLOAD_BYTES,
+    VARIANTS,
+    InvalidImage,
+    process_image_async,
+    variant_name,
+)
 from pydantic import BaseModel
-from typing import List
-from google.cloud import storage
+from typing import List, Optional
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+# Groups with at least this many members are created by a background job
+# (202 Accepted), as are groups of clients sending `Prefer: respond-async`.
+GROUP_ASYNC_MEMBER_THRESHOLD = int(os.getenv("GROUP_ASYNC_MEMBER_THRESHOLD", "50"))
+
 
 # Define a Pydantic model for the request body
 class CreateGroupRequest(BaseModel):
@@ -30,48 +76,161 @@ class CreateGroupResponse(BaseModel):
     links: List[Link]  # Related links
 
 
+# Model for a group creation running in the background
+class CreateGroupAcceptedResponse(BaseModel):
+    job_id: str
+    status: str
+    links: List[Link]  # Related links
+
+
 # Model for a paginated list of groups
 class PaginatedGroupsResponse(BaseModel):
     data: List[CreateGroupResponse]
     links: List[Link]  # Links for pagination
 
 
-# GCP Bucket Configuration
-BUCKET_NAME = "cache-me-outside"
+async def upload_to_gcp(variants: dict, destination_blob_name: str) -> str:
+    """
+    Uploads a processed photo and its size variants to GCP bucket and
+    returns the public URI of the photo.
+    """
+    storage = get_storage()
+    try:
+        # upload every variant at the same time
+        uploads = [
+            run_in_storage_pool(
+                storage.upload,
+                variant_name(destination_blob_name, variant),
+                BytesIO(data),
+                "image/png" if variant == "original" else "image/webp",
+            )
+            for variant, data in variants.items()
+        ]
+        return (await asyncio.gather(*uploads))[0]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to upload photo: {str(e)}")
 
 
-def upload_to_gcp(file: UploadFile, destination_blob_name: str) -> str:
+def rename_group_photo(group_photo: str, group_id: int, moved: list) -> str:
     """
-    Uploads a file to GCP bucket and returns the public URI.
+    Moves an uploaded temp photo and its size variants to their final
+    names in the GCP bucket and returns the photo's new URI.
+
+    Every (old name, new name) moved is appended to `moved`, so a failure
+    halfway can be undone with `restore_group_photo`.
     """
-    try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(destination_blob_name)
+    storage = get_storage()
+    temp_blob_name = f"temp/{group_photo.split('/')[-1]}"  # Temp file name
+    new_blob_name = group_photo_name(group_id)
 
-        # Upload the file
-        blob.upload_from_file(file.file)
+    for variant in ["original", *VARIANTS]:
+        name = variant_name(temp_blob_name, variant)
+        # photos uploaded before variants existed only have the original
+        if variant != "original" and storage.stat(name) is None:
+            continue
+        new_name = variant_name(new_blob_name, variant)
+        storage.rename(name, new_name)
+        moved.append((name, new_name))
+        get_photo_cache().invalidate(new_name)
 
-        # Make the file publicly accessible
-        blob.make_public()
+    return storage.public_url(new_blob_name)
 
-        return blob.public_url
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to upload photo: {str(e)}")
+
+def restore_group_photo(moved: list):
+    """
+    Moves the photos `rename_group_photo` moved back to their temp names.
+    """
+    storage = get_storage()
+    for name, new_name in reversed(moved):
+        storage.rename(new_name, name)
+        get_photo_cache().invalidate(new_name)
+
+
+# Room for the multipart boundary and part headers around the photo.
+MULTIPART_OVERHEAD = 64 * 1024
+
+# The form upload_photo parses itself, for the OpenAPI documentation.
+UPLOAD_PHOTO_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"],
+                }
+            }
+        },
+    }
+}
+
+
+def _too_large():
+    return HTTPException(
+        status_code=413, detail=f"Image is larger than {MAX_UPLOAD_BYTES} bytes"
+    )
+
+
+def limit_body(request: Request, limit: int) -> Request:
+    """
+    The request with a body that fails with 413 as soon as more than
+    `limit` bytes of it arrived, for bodies without a Content-Length.
+    """
+    received = 0
+
+    async def receive():
+        nonlocal received
+        message = await request.receive()
+        received += len(message.get("body", b""))
+        if received > limit:
+            raise _too_large()
+        return message
+
+    return Request(request.scope, receive)
 
 
-@router.post("/upload-photo")
-async def upload_photo(file: UploadFile):
+@router.post("/upload-photo", openapi_extra=UPLOAD_PHOTO_BODY)
+async def upload_photo(request: Request):
     """
     Endpoint to upload a photo to GCP bucket and return its URI.
+
+    The photo is validated, stripped of its metadata and stored as PNG,
+    together with smaller WebP variants (see services/images.py).
+
+    The form is parsed here rather than by FastAPI, so an upload larger
+    than IMAGE_MAX_UPLOAD_BYTES is rejected before it is buffered.
     """
+    limit = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > limit:
+        raise _too_large()
+
+    form = await limit_body(request, limit).form(max_files=1)
     try:
-        # Generate a unique file name for the photo
-        destination_blob_name = f"temp/{file.filename}"
-        public_url = upload_to_gcp(file, destination_blob_name)
-        return {"uri": public_url}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        file = form.get("file")
+        if not isinstance(file, UploadFile):
+            raise HTTPException(status_code=422, detail="The photo is missing")
+        if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+            raise _too_large()
+
+        try:
+            data = await file.read()
+            # the image work is CPU heavy, it runs in worker processes
+            variants = await process_image_async(data)
+        except InvalidImage as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        try:
+            # Generate a unique file name for the photo
+            stem = os.path.splitext(file.filename)[0]
+            destination_blob_name = f"temp/{stem}.png"
+            public_url = await upload_to_gcp(variants, destination_blob_name)
+            return {"uri": public_url}
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        await form.close()
 
 
 # For OpenAPI documentation
@@ -93,6 +252,14 @@ async def upload_photo(file: UploadFile):
         },
         202: {
             "description": "Request accepted and processing asynchronously. Use the provided URL to check status.",
+            "model": CreateGroupAcceptedResponse,
+            "headers": {
+                "Location": {
+                    "description": "URL of the job creating the group",
+                    "schema": {"type": "string"},
+                    "example": "/jobs/4f1c2a9e8b7d4c3a9e1f0b2c3d4e5f60",
+                }
+            },
         },
         400: {"description": "Bad Request - Could not create the group"},
     },
@@ -100,50 +267,31 @@ async def upload_photo(file: UploadFile):
 async def create_new_group(
     request: CreateGroupRequest,
     response: Response = None,
+    prefer: Optional[str] = Header(None),
 ):
     try:
-        name = request.name
-        member_emails = request.members
-        group_photo = request.group_photo
-        sql = SQLMachine()
-
-        # Insert group into the database
-        group_id = sql.insert(
-            "group_service_db",
-            "groups",
-            {
-                "group_name": name,
-                "group_photo": group_photo,  # Save the URI in the database
-            },
-        )
+        if _should_run_async(request, prefer):
+            try:
+                job_id = await get_job_queue().submit(
+                    "create_group", request.model_dump()
+                )
+            except QueueFull:
+                # too much queued already, create the group right away
+                pass
+            else:
+                accepted = CreateGroupAcceptedResponse(
+                    job_id=job_id,
+                    status="queued",
+                    links=[{"rel": "status", "href": f"jobs/{job_id}"}],
+                )
+                return JSONResponse(
+                    status_code=202,
+                    content=accepted.model_dump(),
+                    headers={"Location": f"/jobs/{job_id}"},
+                )
 
-        # Insert members into the database
-        for email in member_emails:
-            uid = get_uid_from_email(email)
-            sql.insert(
-                "group_service_db",
-                "group_members",
-                {"user_id": uid, "group_id": group_id},
-            )
-
-        # Rename the photo in GCP bucket to include the group_id
-        if group_photo:
-            storage_client = storage.Client()
-            bucket = storage_client.bucket(BUCKET_NAME)
-            blob = bucket.blob(f"temp/{group_photo.split('/')[-1]}")  # Temp file name
-            new_blob_name = f"groups/{group_id}_photo.png"
-            bucket.rename_blob(blob, new_blob_name)
-
-            # Update the database with the new URI
-            updated_photo_uri = (
-                f"https://storage.googleapis.com/{BUCKET_NAME}/{new_blob_name}"
-            )
-            sql.update(
-                "group_service_db",
-                "groups",
-                {"group_photo": updated_photo_uri},
-                {"group_id": group_id},
-            )
+        name = request.name
+        group_id = await create_group(name, request.members, request.group_photo)
 
         # HATEOAS links
         links = [
@@ -162,43 +310,258 @@ async def create_new_group(
         )
 
 
+def _should_run_async(request: CreateGroupRequest, prefer: Optional[str]) -> bool:
+    preferences = [p.strip().lower() for p in (prefer or "").split(",")]
+    return (
+        "respond-async" in preferences
+        or len(request.members) >= GROUP_ASYNC_MEMBER_THRESHOLD
+    )
+
+
+async def create_group(
+    name: str, member_emails: List[str], group_photo: str = None, job_id: str = None
+):
+    """
+    Creates a group with its members and moves its photo into place.
+    Returns the new group's id.
+
+    With `job_id`, the group's id is recorded as the result of that job in
+    the same transaction, so a retry of the job knows the group exists.
+    """
+    sql = AsyncSQLMachine()
+
+    # Resolve every member email with a single query before writing
+    uids = await get_uids_from_emails(member_emails)
+
+    # Create the group and its members as one transaction so a failure
+    # halfway doesn't leave a half-built group behind
+    async with sql.transaction() as tx:
+        # Insert group into the database, the photo is added below
+        group_id = await tx.insert(
+            "group_service_db",
+            "groups",
+            {
+                "group_name": name,
+                "member_count": len(uids),  # denormalized for group lists
+            },
+        )
+
+        # Insert all members into the database at once
+        await tx.insert_many(
+            "group_service_db",
+            "group_members",
+            [{"user_id": uid, "group_id": group_id} for uid in uids],
+        )
+
+        if job_id is not None:
+            await tx.update(
+                "group_service_db",
+                "jobs",
+                {"result": json.dumps({"group_id": group_id})},
+                {"job_id": job_id},
+            )
+
+    await complete_group(group_id, group_photo, job_id)
+
+    return group_id
+
+
+async def complete_group(group_id: int, group_photo: str = None, job_id: str = None):
+    """
+    The steps of a group creation after its commit.
+
+    The photo is moved after the commit, so the transaction doesn't hold a
+    connection and the new rows' locks during the storage calls. If that
+    fails the group is removed again, and the photo is back at its temp
+    name for a retry.
+    """
+    if group_photo:
+        try:
+            await attach_group_photo(group_photo, group_id)
+        except Exception:
+            await discard_group(group_id, job_id)
+            raise
+
+    # drop anything cached for this id, e.g. from a deleted group that
+    # had the same id
+    await invalidate_group(group_id)
+
+
+async def attach_group_photo(group_photo: str, group_id: int):
+    """
+    Moves an uploaded temp photo to the group's name in the GCP bucket and
+    saves its new URI. On failure the photo is moved back.
+    """
+    moved = []
+    try:
+        # Rename the photo in GCP bucket to include the group_id
+        updated_photo_uri = await run_in_storage_pool(
+            rename_group_photo, group_photo, group_id, moved
+        )
+
+        # Update the database with the new URI
+        await AsyncSQLMachine().update(
+            "group_service_db",
+            "groups",
+            {"group_photo": updated_photo_uri},
+            {"group_id": group_id},
+        )
+    except Exception:
+        if moved:
+            try:
+                await run_in_storage_pool(restore_group_photo, moved)
+            except Exception:
+                logger.exception(f"Could not move back the photo of group {group_id}")
+        raise
+
+
+async def discard_group(group_id: int, job_id: str = None):
+    """
+    Deletes a group whose creation failed after its commit, and forgets it
+    as the result of the job creating it.
+    """
+    try:
+        async with AsyncSQLMachine().transaction() as tx:
+            await tx.delete("group_service_db", "group_members", {"group_id": group_id})
+            await tx.delete("group_service_db", "groups", {"group_id": group_id})
+            if job_id is not None:
+                await tx.update(
+                    "group_service_db",
+                    "jobs",
+                    {"result": None},
+                    {"job_id": job_id},
+                )
+    except Exception:
+        logger.exception(f"Could not discard the half-created group {group_id}")
+
+
+@job_handler("create_group")
+async def create_group_job(payload: dict):
+    """
+    Runs a group creation accepted with 202, see services/jobs.py.
+    """
+    job_id = current_job_id()
+    job = await get_job(job_id)
+    if job is not None and job.result is not None:
+        # an earlier attempt created the group and was interrupted after
+        # the commit, only the steps after it are left
+        group_id = json.loads(job.result)["group_id"]
+        rows = await AsyncSQLMachine(primary=True).select(
+            "group_service_db",
+            "groups",
+            {"group_id": group_id},
+            columns=("group_photo",),
+        )
+        if rows:
+            photo = payload.get("group_photo") if rows[0].group_photo is None else None
+            await complete_group(group_id, photo, job_id)
+        return {"group_id": group_id}
+
+    try:
+        group_id = await create_group(
+            payload["name"], payload["members"], payload.get("group_photo"), job_id
+        )
+    except UnknownMember as e:
+        # retrying won't make the emails known
+        raise PermanentJobError(str(e))
+
+    return {"group_id": group_id}
+
+
 @router.get("/groups/{group_id}/photo")
-def get_group_photo(group_id: int):
+async def get_group_photo(
+    group_id: int,
+    request: Request,
+    size: Optional[str] = Query(
+        None, description="Size variant: thumb, small, medium or original"
+    ),
+):
+    """
+    Streams the group's photo from storage. Supports Range requests and
+    conditional requests against an ETag derived from the stored object's
+    generation.
+
+    With `size`, a smaller WebP variant is served to clients that accept
+    WebP; other clients get the original PNG.
+    """
+    if size is not None and size != "original" and size not in VARIANTS:
+        raise HTTPException(status_code=400, detail=f"Unknown photo size: {size}")
+
     try:
         # Access your SQL database to fetch the photo path
-        sql = SQLMachine()
-        result = sql.select("group_service_db", "groups", {"group_id": group_id})
-        if not result or not result[0]["group_photo"]:
+        sql = AsyncSQLMachine()
+        result = await sql.select(
+            "group_service_db",
+            "groups",
+            {"group_id": group_id},
+            columns=("group_photo",),
+        )
+        if not result or not result[0].group_photo:
             raise HTTPException(status_code=404, detail="Group photo not found")
 
-        photo_uri = result[0]["group_photo"]
-
-        # Extract the object name from the URI
-        object_name = photo_uri.split(f"{BUCKET_NAME}/")[-1]
-
-        # Access the bucket and fetch the object
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(object_name)
+        photo_uri = result[0].group_photo
+        name = object_name(photo_uri)
+        storage = get_storage()
+
+        # Pick the variant, falling back to the original if the client
+        # can't take WebP or the photo has no variants
+        accept = request.headers.get("accept", "*/*")
+        info = path = None
+        if size in VARIANTS and ("image/webp" in accept or "*/*" in accept):
+            info, path = await run_in_storage_pool(
+                fetch_photo, storage, variant_name(name, size)
+            )
+        if info is None:
+            # Look the object up, a miss is streamed from storage and copied
+            # to the local photo cache meanwhile
+            info, path = await run_in_storage_pool(fetch_photo, storage, name)
+        if info is None:
+            raise HTTPException(status_code=404, detail="Group photo not found")
 
-        # Serve the file
-        return Response(content=blob.download_as_bytes(), media_type="image/png")
+        if path is not None:
+            iter_range = lambda start, end: iter_file_range(path, start, end)
+        else:
+            iter_range = lambda start, end: storage.iter_range(info, start, end)
+
+        # Stream the file, chunk by chunk
+        media_type = info.content_type
+        if media_type is None:
+            media_type = "image/webp" if info.name.endswith(".webp") else "image/png"
+        return ranged_response(
+            info.size,
+            f'"{info.generation}"',
+            media_type,
+            iter_range,
+            request.headers,
+            vary="Accept" if size is not None else None,
+        )
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Failed to retrieve group photo: {str(e)}"
         )
 
 
-def get_uid_from_email(email: str):
+class UnknownMember(Exception):
+    """
+    Raised when a member email doesn't belong to any user.
+    """
+
+
+async def get_uids_from_emails(emails: List[str]):
     """
-    Temporary fix to get group creation to work properly.
+    Resolves a list of emails to user ids with a single query, keeping
+    the order of the emails and dropping duplicates (ignoring case, like
+    the match itself).
     TODO: REPLACE WITH CALL TO USER MICROSERVICE
     """
-    sql = SQLMachine()
+    emails = list({email.casefold(): email for email in emails}.values())
+    uids = await users.get_uids_from_emails(emails)
 
-    result = sql.select("user_service_db", "users", {"email": email})
-    if not result:
-        raise Exception("No user with this email found.")
+    missing = [email for email in emails if email not in uids]
+    if missing:
+        raise UnknownMember(f"No user with these emails found: {', '.join(missing)}")
 
-    return result[0][0]
+    return [uids[email] for email in emails]
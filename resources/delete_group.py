@@ -1,8 +1,28 @@
-from fastapi import APIRouter, HTTPException, Response, Query
-from services.sql_comands import SQLMachine
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Response, Query
+from services.async_sql_comands import AsyncSQLMachine
+from services.response_cache import invalidate_group
+from services.photo_cache import get_photo_cache
+from services.storage import get_storage, object_name, run_in_storage_pool
+from services.images import VARIANTS, variant_name
+from services.jobs import QueueFull, get_job_queue, job_handler
+from resources.batch_get_groups import GROUP_BATCH_MAX_SIZE
+from pydantic import BaseModel
+from typing import List
 
 router = APIRouter()
 
+
+# request model
+class BatchDeleteGroupsRequest(BaseModel):
+    group_ids: List[int]
+
+
+# response model
+class BatchDeleteGroupsResponse(BaseModel):
+    deleted: List[int]
+    not_found: List[int]
+
+
 @router.delete(
     "/groups/{group_id}",
     status_code=204,
@@ -13,18 +33,120 @@ router = APIRouter()
         500: {"description": "Something strange happened."}
     },
 )
-def delete_group(
-    group_id: str
+async def delete_group(
+    group_id: int,
+    background_tasks: BackgroundTasks,
 ):
-    sql = SQLMachine()
-
-    result = sql.delete("group_service_db", "group_members", {"group_id": group_id})
-    result = sql.delete("group_service_db", "groups", {"group_id": group_id})
+    try:
+        deleted = await delete_groups([group_id], background_tasks)
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-    if result == 0:
+    if not deleted:
         raise HTTPException(status_code=404, detail="Group not found")
-    
-    if result > 1:
-        raise HTTPException(status_code=500, detail=f"Too many ({result}) rows deleted.")
-    
-    return Response(status_code=204)
\ No newline at end of file
+
+    return Response(status_code=204)
+
+
+@router.post(
+    "/groups:batchDelete",
+    response_model=BatchDeleteGroupsResponse,
+    status_code=200,
+    summary="Delete many groups by their GroupIDs",
+    description="Delete several groups, their memberships and their photos at "
+    "once. Unknown IDs are listed in `not_found`. At most "
+    f"{GROUP_BATCH_MAX_SIZE} IDs per request.",
+    responses={
+        400: {"description": "Bad Request - Too many group IDs in one request"},
+        500: {"description": "Something strange happened."},
+    },
+)
+async def batch_delete_groups(
+    request: BatchDeleteGroupsRequest,
+    background_tasks: BackgroundTasks,
+):
+    group_ids = list(dict.fromkeys(request.group_ids))
+    if len(group_ids) > GROUP_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {GROUP_BATCH_MAX_SIZE} groups can be deleted at once",
+        )
+
+    try:
+        deleted = await delete_groups(group_ids, background_tasks)
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return BatchDeleteGroupsResponse(
+        deleted=[group_id for group_id in group_ids if group_id in deleted],
+        not_found=[group_id for group_id in group_ids if group_id not in deleted],
+    )
+
+
+async def delete_groups(group_ids, background_tasks: BackgroundTasks):
+    """
+    Deletes groups with their memberships in one transaction and schedules
+    the removal of their photos from storage. Returns the set of ids of
+    the groups that existed.
+    """
+    if not group_ids:
+        return set()
+
+    sql = AsyncSQLMachine()
+    async with sql.transaction() as tx:
+        groups = await tx.select(
+            "group_service_db",
+            "groups",
+            {"group_id": group_ids},
+            columns=("group_id", "group_photo"),
+        )
+
+        await tx.delete("group_service_db", "group_members", {"group_id": group_ids})
+        result = await tx.delete("group_service_db", "groups", {"group_id": group_ids})
+        if result != len(groups):
+            # rolls the whole delete back
+            raise RuntimeError(
+                f"Unexpected number of rows deleted ({result}, expected {len(groups)})."
+            )
+
+    photo_names = []
+    for group in groups:
+        await invalidate_group(group.group_id)
+        if group.group_photo:
+            name = object_name(group.group_photo)
+            for variant in ["original", *VARIANTS]:
+                photo_names.append(variant_name(name, variant))
+    for name in photo_names:
+        get_photo_cache().invalidate(name)
+
+    # the bucket is cleaned up in the background, the response doesn't
+    # have to wait for storage
+    if photo_names:
+        try:
+            await get_job_queue().submit("delete_photos", {"names": photo_names})
+        except QueueFull:
+            background_tasks.add_task(delete_photos, {"names": photo_names})
+
+    return {group.group_id for group in groups}
+
+
+@job_handler("delete_photos")
+async def delete_photos(payload: dict):
+    """
+    Removes the photos of deleted groups from storage. Objects that are
+    already gone are skipped, so the job can safely be retried.
+    """
+    storage = get_storage()
+
+    def delete_if_exists(name):
+        if storage.stat(name) is None:
+            return False
+        storage.delete(name)
+        return True
+
+    deleted = 0
+    for name in payload["names"]:
+        if await run_in_storage_pool(delete_if_exists, name):
+            deleted += 1
+
+    return {"deleted": deleted}
@@ -1,7 +1,11 @@
 from fastapi import APIRouter, HTTPException, Response, Query
-from services.sql_comands import SQLMachine
+from fastapi.responses import ORJSONResponse
+from services.async_sql_comands import AsyncSQLMachine
+from services import users
+from services.cursors import encode_cursor, decode_cursor
+from services.fields import parse_fields
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 router = APIRouter()
 
@@ -18,8 +22,9 @@ class Link(BaseModel):
 class GetGroupResponse(BaseModel):
     group_id: int
     name: str
-    group_photo: str
-    members: List[str]
+    group_photo: Optional[str] = None  # None if the group has no photo
+    member_count: int
+    members: Optional[List[str]] = None  # unless left out with `fields`
     links: List[Link]  # HATEOAS links
 
 
@@ -27,6 +32,7 @@ class GetGroupResponse(BaseModel):
 class PaginatedGroupsResponse(BaseModel):
     data: List[GetGroupResponse]
     links: List[Link]  # Pagination links
+    total_count: Optional[int] = None  # only with include_total=true
 
 
 @router.get(
@@ -34,7 +40,11 @@ class PaginatedGroupsResponse(BaseModel):
     response_model=PaginatedGroupsResponse,
     status_code=200,
     summary="Get all groups",
-    description="Retrieve a paginated list of all groups",
+    description="Retrieve a paginated list of all groups. Pages are addressed "
+    "with the opaque `after`/`before` cursors from the `next`/`prev` links; "
+    "`offset` is still accepted for the first request. `fields` limits every "
+    "group to the listed fields, e.g. `fields=name,group_photo,member_count`; "
+    "the members are only looked up when `members` is one of them.",
     responses={
         202: {
             "description": "Request accepted but still processing. Check back later for results."
@@ -42,45 +52,98 @@ class PaginatedGroupsResponse(BaseModel):
         400: {"description": "Bad Request - Could not fetch the groups"},
     },
 )
-def get_all_groups(user_id: str, limit: int = Query(10), offset: int = Query(0)):
+async def get_all_groups(
+    user_id: str,
+    limit: int = Query(10),
+    offset: int = Query(0),
+    after: Optional[str] = Query(None),
+    before: Optional[str] = Query(None),
+    include_total: bool = Query(False),
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields of each group (default all)"
+    ),
+):
     try:
-        sql = SQLMachine()
+        after_id = decode_cursor(after) if after else None
+        before_id = decode_cursor(before) if before else None
+        selected = parse_fields(fields, GetGroupResponse, always=("group_id",))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        # Step 1: Fetch all group_ids associated with the user_id
-        user_groups = sql.select(
-            "group_service_db", "group_members", {"user_id": user_id}
+    try:
+        sql = AsyncSQLMachine()
+
+        # Step 1: Fetch only the requested page of group_ids for the user.
+        # One extra row is fetched to know whether there is another page.
+        if after_id is not None or before_id is not None:
+            page = await sql.select_keyset(
+                "group_service_db",
+                "group_members",
+                "group_id",
+                limit,
+                after=after_id,
+                before=before_id,
+                data={"user_id": user_id},
+                columns=("group_id",),
+            )
+            user_groups = page["results"]
+            if before_id is not None:
+                has_prev, has_next = page["has_more"], True
+            else:
+                has_prev, has_next = True, page["has_more"]
+        else:
+            user_groups = await sql.select(
+                "group_service_db",
+                "group_members",
+                {"user_id": user_id},
+                order_by="group_id",
+                limit=limit + 1,
+                offset=offset,
+                columns=("group_id",),
+            )
+            has_prev, has_next = offset > 0, len(user_groups) > limit
+            user_groups = user_groups[:limit]
+
+        group_ids = [group.group_id for group in user_groups]
+
+        # Step 2: Fetch the details of every group on the page at once
+        group_rows = await sql.select(
+            "group_service_db", "groups", {"group_id": group_ids}
         )
-        group_ids = [
-            group[0] for group in user_groups
-        ]  # Access the tuple index for group_id
+        group_details = {group.group_id: group for group in group_rows}
+
+        # Steps 3 and 4 are skipped for summaries without the members
+        expand_members = selected is None or "members" in selected
+        member_user_ids = {}
+        emails = {}
+        if expand_members:
+            # Step 3: Fetch the memberships of every group on the page at once
+            group_members = await sql.select(
+                "group_service_db", "group_members", {"group_id": group_ids}
+            )
+            for member in group_members:
+                member_user_ids.setdefault(member.group_id, []).append(
+                    member.user_id
+                )
+
+            # Step 4: Fetch the email addresses of every member at once
+            user_ids = {uid for uids in member_user_ids.values() for uid in uids}
+            member_users = await users.get_users(user_ids)
+            emails = {uid: user.email for uid, user in member_users.items()}
 
-        # Step 2: Fetch group details for each group_id
         groups = []
         for group_id in group_ids:
-            # Fetch group details
-            group_details = sql.select(
-                "group_service_db", "groups", {"group_id": group_id}
-            )
-            if not group_details:
+            if group_id not in group_details:
                 continue
-            group_details = group_details[0]  # Get the first result
+            group = group_details[group_id]
 
-            # Step 3: Fetch all user_ids associated with this group_id
-            group_members = sql.select(
-                "group_service_db", "group_members", {"group_id": group_id}
-            )
-            member_user_ids = [
-                member[1] for member in group_members
-            ]  # Access user_id from tuple
-
-            # Step 4: Fetch email addresses for each user_id
-            member_emails = []
-            for member_user_id in member_user_ids:
-                user_details = sql.select(
-                    "user_service_db", "users", {"id": member_user_id}
-                )
-                if user_details:
-                    member_emails.append(user_details[0][1])  # Access email from tuple
+            member_emails = None
+            if expand_members:
+                member_emails = [
+                    emails[uid]
+                    for uid in member_user_ids.get(group_id, [])
+                    if uid in emails
+                ]
 
             # Create HATEOAS links
             group_links = [
@@ -89,39 +152,63 @@ def get_all_groups(user_id: str, limit: int = Query(10), offset: int = Query(0))
                 {"rel": "expenses", "href": f"groups/{group_id}/expenses"},
             ]
 
-            groups.append(
-                GetGroupResponse(
-                    group_id=group_details[0],  # Access group_id
-                    name=group_details[1],  # Access group_name
-                    group_photo=group_details[2],
-                    members=member_emails,
-                    links=group_links,
-                )
-            )
-
-        # Step 5: Add pagination links
-        pagination_links = [
-            {"rel": "current", "href": f"groups?limit={limit}&offset={offset}"},
-        ]
-        if offset > 0:
+            # plain dicts in the shape of GetGroupResponse, see below
+            group_response = {
+                "group_id": group.group_id,
+                "name": group.group_name,
+                "group_photo": group.group_photo,
+                "member_count": group.member_count,
+                "members": member_emails,
+                "links": group_links,
+            }
+            if selected is not None:
+                group_response = {
+                    field: value
+                    for field, value in group_response.items()
+                    if field in selected
+                }
+            groups.append(group_response)
+
+        # Step 5: Add pagination links, the cursors are the group_ids at
+        # the edges of this page. Every page keeps the same fields.
+        page_fields = f"&fields={','.join(sorted(selected))}" if selected else ""
+        if after:
+            current = f"groups?limit={limit}&after={after}"
+        elif before:
+            current = f"groups?limit={limit}&before={before}"
+        else:
+            current = f"groups?limit={limit}&offset={offset}"
+        pagination_links = [{"rel": "current", "href": current + page_fields}]
+
+        if group_ids and has_prev:
             pagination_links.append(
                 {
                     "rel": "prev",
-                    "href": f"groups?limit={limit}&offset={max(0, offset - limit)}",
+                    "href": f"groups?limit={limit}&before={encode_cursor(group_ids[0])}"
+                    + page_fields,
                 }
             )
-        if offset + limit < len(groups):
+        if group_ids and has_next:
             pagination_links.append(
                 {
                     "rel": "next",
-                    "href": f"groups?limit={limit}&offset={offset + limit}",
+                    "href": f"groups?limit={limit}&after={encode_cursor(group_ids[-1])}"
+                    + page_fields,
                 }
             )
 
-        # Apply pagination
-        paginated_groups = groups[offset : offset + limit]
+        total_count = None
+        if include_total:
+            total_count = await sql.count(
+                "group_service_db", "group_members", {"user_id": user_id}
+            )
 
-        return PaginatedGroupsResponse(data=paginated_groups, links=pagination_links)
+        # The page is built from rows of known types, so it is serialized
+        # straight away instead of being validated against the response
+        # model first, which took longer than the queries on big pages
+        return ORJSONResponse(
+            {"data": groups, "links": pagination_links, "total_count": total_count}
+        )
 
     except Exception as e:
         print(f"Error fetching groups: {repr(e)}")
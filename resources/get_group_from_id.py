@@ -1,7 +1,10 @@
-from fastapi import APIRouter, HTTPException, Response
-from services.sql_comands import SQLMachine
+from fastapi import APIRouter, HTTPException, Response, Header, Query
+from services.async_sql_comands import AsyncSQLMachine
+from services import users
+from services.fields import fields_key, parse_fields
+from services.response_cache import cached_group_response
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 router = APIRouter()
 
@@ -16,8 +19,9 @@ class Link(BaseModel):
 class GetGroupResponse(BaseModel):
     group_id: int
     name: str
-    group_photo: str
-    members: List[str]
+    group_photo: Optional[str] = None  # None if the group has no photo
+    member_count: int
+    members: Optional[List[str]] = None  # unless left out with `fields`
     labels: List[str]
     links: List[Link]  # HATEOAS links
 
@@ -27,32 +31,74 @@ class GetGroupResponse(BaseModel):
     response_model=GetGroupResponse,
     status_code=200,
     summary="Get a group by its GroupID",
-    description="Retrieve detailed information about a group by its unique ID.",
+    description="Retrieve detailed information about a group by its unique ID. "
+    "`fields` limits the response to the listed fields, e.g. "
+    "`fields=name,group_photo,member_count`; the members are only looked up "
+    "when `members` is one of them.",
     responses={
         202: {
             "description": "Request accepted but still processing. Check back later for results."
         },
+        304: {"description": "Not Modified - the If-None-Match ETag is still current."},
+        400: {"description": "Bad Request - Unknown fields"},
         404: {"description": "Group not found. The specified group ID does not exist."},
     },
 )
-def get_group_from_id(
-    group_id: str,
+async def get_group_from_id(
+    group_id: int,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return (default all)"
+    ),
+    if_none_match: Optional[str] = Header(None),
 ):
-    sql = SQLMachine()
+    try:
+        selected = parse_fields(fields, GetGroupResponse, always=("group_id",))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    kind = "detail" if selected is None else f"detail:{fields_key(selected)}"
+    return await cached_group_response(
+        group_id,
+        kind,
+        lambda: build_group_response(group_id, selected),
+        if_none_match,
+        include=selected,
+    )
+
 
-    result = sql.select("group_service_db", "groups", {"group_id": group_id})
+async def build_group_response(group_id: int, fields=None):
+    # the response is cached for every client, so it is built from the
+    # primary: a lagging replica could still show a deleted group
+    sql = AsyncSQLMachine(primary=True)
+
+    result = await sql.select("group_service_db", "groups", {"group_id": group_id})
 
     # if no result is found, raise a 404 error
     if not result:
         raise HTTPException(status_code=404, detail="Group not found")
     
-    result = result[0]
+    group = result[0]
+
+    # a summary doesn't need the members, nor a lookup per member
+    if fields is not None and "members" not in fields:
+        return make_group_response(group, None)
+
+    members_result = await sql.select(
+        "group_service_db", "group_members", {"group_id": group_id}, columns=("user_id",)
+    )
+    members = await get_user_names_from_ids(
+        [member.user_id for member in members_result]
+    )
 
-    members_result = sql.select("group_service_db", "group_members", {"group_id": group_id})
-    members = []
+    return make_group_response(group, members)
 
-    for member in members_result:
-        members.append(get_user_name_from_id(member[1]))
+
+def make_group_response(group, members):
+    """
+    Builds the response for a groups row and the names of its members
+    (None if they weren't asked for).
+    """
+    group_id = group.group_id
 
     # TODO: get labels from other tables
     # result["labels"] = result["labels"].split(",") if "labels" in result else []
@@ -65,22 +111,24 @@ def get_group_from_id(
     ]
 
     return GetGroupResponse(
-        group_id=result[0],
-        name=result[1],
-        group_photo=result[2],
+        group_id=group_id,
+        name=group.group_name,
+        group_photo=group.group_photo,
+        member_count=group.member_count,
         members=members,
         labels=[],
         links=links,
     )
 
-def get_user_name_from_id(id):
+
+async def get_user_names_from_ids(ids):
     """
+    Looks up the names of the users with these ids, in order, with one
+    batched lookup.
         TODO: Replace with call to user microservice.
     """
-    sql = SQLMachine()
-
-    result = sql.select("user_service_db", "users", {"id": id})
-    if not result:
+    result = await users.get_users(ids)
+    if len(result) < len(set(ids)):
         raise Exception("No user with this id found.")
 
-    return result[0][2]
\ No newline at end of file
+    return [result[id].name for id in ids]
\ No newline at end of file
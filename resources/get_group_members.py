@@ -1,7 +1,9 @@
-from fastapi import APIRouter, HTTPException, Response
-from services.sql_comands import SQLMachine
+from fastapi import APIRouter, HTTPException, Response, Header
+from services.async_sql_comands import AsyncSQLMachine
+from services import users
+from services.response_cache import cached_group_response
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 router = APIRouter()
 
@@ -37,39 +39,59 @@ class GetGroupMembersResponse(BaseModel):
         202: {
             "description": "Request accepted but still processing. Check back later for results."
         },
+        304: {"description": "Not Modified - the If-None-Match ETag is still current."},
         404: {"description": "Group not found. The specified group ID does not exist."},
     },
 )
-def get_group_from_id(
-    group_id: str,
+async def get_group_from_id(
+    group_id: int,
+    if_none_match: Optional[str] = Header(None),
 ):
-    sql = SQLMachine()
+    return await cached_group_response(
+        group_id,
+        "members",
+        lambda: build_group_members_response(group_id),
+        if_none_match,
+    )
+
 
-    result = sql.select("group_service_db", "groups", {"group_id": group_id})
+async def build_group_members_response(group_id: int):
+    # cached for every client, so read from the primary (see
+    # build_group_response)
+    sql = AsyncSQLMachine(primary=True)
+
+    # only checks that the group exists
+    result = await sql.select(
+        "group_service_db", "groups", {"group_id": group_id}, columns=("group_id",)
+    )
 
     # if no result is found, raise a 404 error
     if not result:
         raise HTTPException(status_code=404, detail="Group not found")
-    
-    result = result[0]
 
-    members_result = sql.select("group_service_db", "group_members", {"group_id": group_id})
+    members_result = await sql.select(
+        "group_service_db", "group_members", {"group_id": group_id}, columns=("user_id",)
+    )
     members = []
 
-    for member in members_result:
-        user_info = get_user_info_from_id(member[1])
+    # plain dicts in the shape of Member, serialized without validating
+    # them against the response model again (see cached_group_response)
+    user_infos = await get_user_infos_from_ids(
+        [member.user_id for member in members_result]
+    )
+    for user_info in user_infos:
         user_links = [
-            {"rel": "user", "href": f"/api/users/{user_info[0]}"}
+            {"rel": "user", "href": f"/api/users/{user_info.id}"}
         ]
         
-        members.append(Member(
-            id=user_info[0],
-            email=user_info[1],
-            name=user_info[2],
-            currency_preference=user_info[3],
-            profile_pic=user_info[4],
-            links=user_links
-        ))
+        members.append({
+            "id": user_info.id,
+            "email": user_info.email,
+            "name": user_info.name,
+            "currency_preference": user_info.currency_preference,
+            "profile_pic": user_info.profile_pic,
+            "links": user_links,
+        })
     
     # HATEOAS links
     links = [
@@ -78,19 +100,15 @@ def get_group_from_id(
         {"rel": "expenses", "href": f"/api/groups/{group_id}/expenses"},
     ]
 
-    return GetGroupMembersResponse(
-        members=members,
-        links=links,
-    )
+    return {"members": members, "links": links}
 
-def get_user_info_from_id(id):
+async def get_user_infos_from_ids(ids):
     """
+    Looks up the users with these ids, in order, with one batched lookup.
         TODO: Replace with call to user microservice.
     """
-    sql = SQLMachine()
-
-    result = sql.select("user_service_db", "users", {"id": id})
-    if not result:
+    result = await users.get_users(ids)
+    if len(result) < len(set(ids)):
         raise Exception("No user with this id found.")
 
-    return result[0]
\ No newline at end of file
+    return [result[id] for id in ids]
\ No newline at end of file
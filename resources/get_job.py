@@ -0,0 +1,66 @@
+import json
+
+from fastapi import APIRouter, HTTPException, Response
+from services.jobs import QUEUED, RUNNING, SUCCEEDED, get_job
+from pydantic import BaseModel
+from typing import Any, List, Optional
+
+router = APIRouter()
+
+### HATEOAS ###
+
+# pydantic model for HATEOAS links
+class Link(BaseModel):
+    rel: str
+    href: str
+
+# response model
+class GetJobResponse(BaseModel):
+    job_id: str
+    kind: str
+    status: str  # queued, running, succeeded or failed
+    attempts: int
+    result: Optional[Any] = None  # only once succeeded
+    error: Optional[str] = None  # only once failed
+    links: List[Link]  # HATEOAS links
+
+
+@router.get(
+    "/jobs/{job_id}",
+    response_model=GetJobResponse,
+    status_code=200,
+    summary="Get the status of a background job",
+    description="Poll a job started by a request that returned 202 Accepted, "
+    "e.g. the creation of a large group. Once it succeeded, the links point "
+    "to the created resource.",
+    responses={
+        404: {"description": "Job not found. The specified job ID does not exist."},
+    },
+)
+async def get_job_status(job_id: str, response: Response):
+    job = await get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    links = [{"rel": "self", "href": f"/jobs/{job_id}"}]
+
+    result = None
+    if job.status == SUCCEEDED and job.result is not None:
+        result = json.loads(job.result)
+        if isinstance(result, dict) and "group_id" in result:
+            links.append(
+                {"rel": "created-resource", "href": f"/groups/{result['group_id']}"}
+            )
+    elif job.status in (QUEUED, RUNNING):
+        # a hint on when to poll again
+        response.headers["Retry-After"] = "1"
+
+    return GetJobResponse(
+        job_id=job.job_id,
+        kind=job.kind,
+        status=job.status,
+        attempts=job.attempts,
+        result=result,
+        error=job.error,
+        links=links,
+    )
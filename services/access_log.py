@@ -0,0 +1,185 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+# Structured logging for the service. Every log record is written as one
+# JSON object per line by a background thread: the code logging only puts
+# the record on a queue, so a slow stdout never blocks a request.
+#
+# Every record carries the id of the request it was logged in (taken from
+# the X-Request-ID header or generated), so the access log line of a
+# request can be matched with its query logs.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Share of successful requests written to the access log. Errors and slow
+# requests are always written.
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("ACCESS_LOG_SAMPLE_RATE", "0.1"))
+ACCESS_LOG_SLOW_MS = float(os.getenv("ACCESS_LOG_SLOW_MS", "1000"))
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+access_logger = logging.getLogger("access")
+
+_request_id = ContextVar("request_id", default=None)
+
+# the record attributes every LogRecord has, anything else came in `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message"}
+
+
+def current_request_id():
+    """
+    The id of the request being handled, or None outside of one.
+    """
+    return _request_id.get()
+
+
+def start_request(request_id=None):
+    """
+    Sets the id of the current request, generating one if the client
+    didn't send any. Returns the id and a token for `end_request`.
+    """
+    request_id = request_id or uuid.uuid4().hex
+    return request_id, _request_id.set(request_id)
+
+
+def end_request(token):
+    _request_id.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a single line of JSON, including any fields
+    passed with `extra=`.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+class _RequestIdFilter(logging.Filter):
+    # runs in the thread logging the record, where the contextvar is set
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The queue never leaves the process, so the record only needs to
+        # be detached from the caller: render the message and traceback
+        # now, leave the JSON formatting to the listener thread.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+
+
+def setup_logging():
+    """
+    Routes every log record through the queue to a JSON handler on
+    stdout. Safe to call more than once.
+    """
+    global _listener
+
+    _route_uvicorn_logs()
+    if _listener is not None:
+        return
+
+    log_queue = queue.SimpleQueue()
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(_RequestIdFilter())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+
+    _listener = QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def _route_uvicorn_logs():
+    # uvicorn gives its loggers stream handlers of their own when it
+    # starts, which write to stdout on the event loop. Called again from
+    # the lifespan, after that happened. Its per-request access log is
+    # turned off in main.py (`--no-access-log` when started with the
+    # uvicorn command), log_access replaces it; a logger uvicorn turned
+    # off has no handlers and stays off.
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        if uvicorn_logger.handlers:
+            uvicorn_logger.handlers = []
+            uvicorn_logger.propagate = True
+
+
+def stop_logging():
+    """
+    Writes out the queued records and stops the logging thread.
+    """
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_access(request, status_code, duration, route, tracker=None):
+    """
+    Writes the access log line of a request: always for errors and slow
+    requests, for a sample of ACCESS_LOG_SAMPLE_RATE of the others.
+    """
+    duration_ms = duration * 1000
+    if (
+        status_code < 400
+        and duration_ms < ACCESS_LOG_SLOW_MS
+        and random.random() >= ACCESS_LOG_SAMPLE_RATE
+    ):
+        return
+
+    fields = {
+        "method": request.method,
+        "route": route,
+        "path": request.url.path,
+        "status": status_code,
+        "duration_ms": round(duration_ms, 2),
+    }
+    if tracker is not None:
+        fields["db_queries"] = tracker.count
+        fields["db_ms"] = round(tracker.db_time * 1000, 2)
+
+    if status_code >= 500:
+        level = logging.ERROR
+    elif duration_ms >= ACCESS_LOG_SLOW_MS:
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+    access_logger.log(level, "request", extra=fields)
@@ -0,0 +1,338 @@
+import aiomysql
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+from functools import partial
+import os
+
+from services.connection_pool import AsyncConnectionPool
+from services.metrics import DB_READS, register_pool, timed_query
+from services.replicas import (
+    CONNECTION_ERRORS,
+    DATABASE_REPLICAS,
+    Replica,
+    ReplicaSet,
+    note_write,
+    reads_from_primary,
+)
+from services.rows import map_rows
+from services.query_builder import (
+    build_select,
+    build_keyset,
+    build_count,
+    build_insert,
+    build_insert_many,
+    build_delete,
+    build_update,
+)
+from services.sql_comands import (
+    keyset_page,
+    count_cache_key,
+    cached_count,
+    cache_count,
+    pool_options,
+)
+
+# Use our .env file to set up the environment variables.
+load_dotenv()
+
+# The process-wide pool shared by every AsyncSQLMachine, created on first
+# use inside the running event loop, and the pools of the read replicas.
+_pool = None
+_replicas = None
+
+
+def get_async_pool():
+    """
+    Returns the process-wide async connection pool, creating it on first
+    use. It is configured by the same DATABASE_POOL_* variables as the
+    synchronous pool.
+    """
+    global _pool
+
+    if _pool is None:
+        _pool = AsyncConnectionPool(AsyncSQLMachine.create_connection, **pool_options())
+        register_pool("async", _pool)
+    return _pool
+
+
+def get_async_replica_set():
+    """
+    Returns the read replicas of AsyncSQLMachine, see get_replica_set.
+    """
+    global _replicas
+
+    if _replicas is None:
+        replicas = []
+        for host, port in DATABASE_REPLICAS:
+            name = f"{host}:{port}"
+            pool = AsyncConnectionPool(
+                partial(AsyncSQLMachine.create_connection, host, port),
+                **pool_options(),
+            )
+            register_pool(f"async-replica-{name}", pool)
+            replicas.append(Replica(name, pool))
+        _replicas = ReplicaSet(replicas)
+    return _replicas
+
+
+async def close_async_pool():
+    """
+    Closes the idle connections of the async pool and of the replica
+    pools, called on shutdown.
+    """
+    global _pool, _replicas
+
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+    if _replicas is not None:
+        for replica in _replicas.replicas:
+            await replica.pool.close()
+        _replicas = None
+
+
+def async_pool_stats():
+    """
+    Returns the stats of the process-wide async pool.
+    """
+    return get_async_pool().stats()
+
+
+@asynccontextmanager
+async def _bound(connection):
+    # a transaction's connection, handed out without going through the pool
+    yield connection
+
+
+async def _run(connection, query, values, result):
+    async with connection.cursor() as cursor:
+        with timed_query(query):
+            await cursor.execute(query, values)
+            if result == "all":
+                return await cursor.fetchall()
+            if result == "one":
+                return await cursor.fetchone()
+            return getattr(cursor, result)
+
+
+class AsyncSQLMachine:
+    """
+    Same API as SQLMachine, but every method is a coroutine so routes can
+    await the database without blocking the event loop.
+    """
+
+    def __init__(self, connection=None, primary=False):
+        # set when the machine runs inside a transaction(), every query
+        # then goes through that one connection
+        self._connection = connection
+        # read from the primary too, for rows that must never be stale
+        self.primary = primary
+
+    @staticmethod
+    async def create_connection(host=None, port=None):
+        """
+        Creates a connection to the SQL database specified by the
+        environment variables, or to a read replica at `host`.
+
+        Returns the connection. Queries should borrow connections from
+        the pool with `connection()` instead of calling this directly.
+        """
+        connection = await aiomysql.connect(
+            host=host or os.getenv("DATABASE_IP"),
+            port=port or int(os.getenv("DATABASE_PORT")),
+            user=os.getenv("DATABASE_UNAME"),
+            password=os.getenv("DATABASE_PWORD"),
+            autocommit=True,
+        )
+        return connection
+
+    def connection(self):
+        """
+        Borrows a connection from the shared pool, use as
+        `async with self.connection() as connection:`.
+        """
+        if self._connection is not None:
+            return _bound(self._connection)
+        return get_async_pool().connection()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Runs a block of queries as a single transaction:
+
+            async with sql.transaction() as tx:
+                await tx.insert(...)
+                await tx.insert_many(...)
+
+        The transaction commits when the block exits and is rolled back if
+        it raises. Nested calls join the outer transaction.
+        """
+        if self._connection is not None:
+            yield self
+            return
+
+        # the pool rolls the connection back if the block raises
+        async with self.connection() as connection:
+            await connection.begin()
+            yield AsyncSQLMachine(connection)
+            await connection.commit()
+
+    async def execute(self, query, values=(), result="all", read_only=False):
+        """
+        Runs a single statement on a pooled connection.
+
+        `result` picks what is returned: "all" rows, "one" row, the
+        "rowcount" or the "lastrowid". `read_only` statements may go to a
+        read replica, see SQLMachine.execute.
+        """
+        if not read_only:
+            note_write()
+        elif self._uses_replicas():
+            replicas = get_async_replica_set()
+            replica = replicas.choose()
+            if replica is not None:
+                try:
+                    async with replica.pool.connection() as connection:
+                        rows = await _run(connection, query, values, result)
+                except CONNECTION_ERRORS as e:
+                    # retried on the primary below
+                    replicas.eject(replica, e)
+                else:
+                    replicas.succeeded(replica)
+                    DB_READS.labels("replica").inc()
+                    return rows
+
+        if read_only:
+            DB_READS.labels("primary").inc()
+        async with self.connection() as connection:
+            return await _run(connection, query, values, result)
+
+    def _uses_replicas(self):
+        return (
+            bool(DATABASE_REPLICAS)
+            and self._connection is None
+            and not self.primary
+            and not reads_from_primary()
+        )
+
+    async def select(
+        self,
+        schema,
+        table,
+        data=None,
+        order_by=None,
+        limit=None,
+        offset=None,
+        columns=None,
+    ):
+        """
+        Select rows from a certain table in a schema within the database.
+        See SQLMachine.select.
+        """
+        query, values = build_select(
+            schema, table, data, order_by, limit, offset, columns
+        )
+        if query is None:
+            return []
+
+        return map_rows(
+            schema, table, columns, await self.execute(query, values, read_only=True)
+        )
+
+    async def select_paginated(self, schema, table, limit, offset, include_count=True):
+        """
+        Select a limited number of entries from a table in a schema within
+        the database. See SQLMachine.select_paginated.
+        """
+        query, values = build_select(schema, table, limit=limit, offset=offset)
+        paginated_results = map_rows(
+            schema, table, None, await self.execute(query, values, read_only=True)
+        )
+
+        total_count = await self.count(schema, table) if include_count else None
+
+        return {"results": paginated_results, "total_count": total_count}
+
+    async def select_keyset(
+        self,
+        schema,
+        table,
+        key,
+        limit,
+        after=None,
+        before=None,
+        data=None,
+        columns=None,
+    ):
+        """
+        Select a page of rows ordered by `key`. See SQLMachine.select_keyset.
+        """
+        query, values = build_keyset(
+            schema, table, key, limit, after, before, data, columns
+        )
+        if query is None:
+            return {"results": [], "has_more": False}
+
+        rows = map_rows(
+            schema, table, columns, await self.execute(query, values, read_only=True)
+        )
+        return keyset_page(rows, limit, before)
+
+    async def count(self, schema, table, data=None, cached=True):
+        """
+        Count the rows of a table which meet the conditions. See
+        SQLMachine.count.
+        """
+        cache_key = count_cache_key(schema, table, data)
+        if cached:
+            total_count = cached_count(cache_key)
+            if total_count is not None:
+                return total_count
+
+        query, values = build_count(schema, table, data)
+        if query is None:
+            return 0
+
+        row = await self.execute(query, values, result="one", read_only=True)
+        total_count = row[0]
+        cache_count(cache_key, total_count)
+
+        return total_count
+
+    async def insert(self, schema, table, data):
+        query, values = build_insert(schema, table, data)
+
+        return await self.execute(query, values, result="lastrowid")
+
+    async def insert_many(self, schema, table, rows):
+        """
+        Insert many rows with a single multi-row INSERT statement. See
+        SQLMachine.insert_many.
+        """
+        if not rows:
+            return 0
+        query, values = build_insert_many(schema, table, rows)
+
+        return await self.execute(query, values, result="rowcount")
+
+    async def delete(self, schema, table, data=None):
+        """
+        Delete all rows from the table which meet the conditions.
+        """
+        query, values = build_delete(schema, table, data)
+        if query is None:
+            return 0
+
+        return await self.execute(query, values, result="rowcount")
+
+    async def update(self, schema, table, update_data, conditions):
+        """
+        Update rows in the specified table within a schema. See
+        SQLMachine.update.
+        """
+        query, values = build_update(schema, table, update_data, conditions)
+        if query is None:
+            return 0
+
+        # Number of rows affected by the update
+        return await self.execute(query, values, result="rowcount")
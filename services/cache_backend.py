@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+
+from services.ttl_cache import TTLCache, MISSING
+
+logger = logging.getLogger(__name__)
+
+# Values are stored as JSON so every backend hands back the same types.
+
+
+class CacheBackend(ABC):
+    """
+    A key/value cache shared by the lookups in `resources/`.
+
+    A lookup that misses (or a backend that is down) returns None, so
+    callers always fall back to the database.
+    """
+
+    def __init__(self):
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+
+    async def get(self, key):
+        return (await self.get_many([key])).get(key)
+
+    @abstractmethod
+    async def get_many(self, keys):
+        """
+        Returns a dict of key -> value for the keys that are cached.
+        """
+        raise NotImplementedError
+
+    async def set(self, key, value, ttl=None):
+        await self.set_many({key: value}, ttl)
+
+    @abstractmethod
+    async def set_many(self, mapping, ttl=None):
+        """
+        Caches every key -> value of the mapping for `ttl` seconds, or
+        forever if `ttl` is None.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, *keys):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def incr(self, key):
+        """
+        Atomically increments the integer stored at the key (starting from
+        0) and returns the new value. Used for versioned keys.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {"hits": self._hits, "misses": self._misses, "errors": self._errors}
+
+    def _count(self, requested, found):
+        self._hits += found
+        self._misses += requested - found
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Caches in this process's memory. Fine for a single worker, but every
+    worker has its own copy and can't see the others' invalidations.
+    """
+
+    def __init__(self, max_size=10000):
+        super().__init__()
+        self._cache = TTLCache(max_size=max_size, ttl=float("inf"))
+        self._incr_lock = threading.Lock()
+
+    async def get_many(self, keys):
+        found = {}
+        for key in keys:
+            raw = self._cache.get(key)
+            if raw is not MISSING:
+                found[key] = json.loads(raw)
+
+        self._count(len(keys), len(found))
+        return found
+
+    async def set_many(self, mapping, ttl=None):
+        ttl = float("inf") if ttl is None else ttl
+        for key, value in mapping.items():
+            self._cache.set(key, json.dumps(value, default=str), ttl)
+
+    async def delete(self, *keys):
+        for key in keys:
+            self._cache.invalidate(key)
+
+    async def incr(self, key):
+        with self._incr_lock:
+            raw = self._cache.get(key)
+            value = (0 if raw is MISSING else json.loads(raw)) + 1
+            self._cache.set(key, json.dumps(value), float("inf"))
+        return value
+
+    def stats(self):
+        return {**super().stats(), **self._cache.stats()}
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Caches in a Redis server (or anything speaking its protocol, e.g. a
+    local redis-server in development), shared by every worker.
+    """
+
+    def __init__(self, url, prefix="group_service:"):
+        super().__init__()
+        import redis.asyncio as redis
+
+        self._redis = redis
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    async def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            raw_values = await self._client.mget([self._prefix + key for key in keys])
+        except (self._redis.RedisError, OSError) as e:
+            self._error("get", e)
+            return {}
+
+        found = {
+            key: json.loads(raw)
+            for key, raw in zip(keys, raw_values)
+            if raw is not None
+        }
+        self._count(len(keys), len(found))
+        return found
+
+    async def set_many(self, mapping, ttl=None):
+        if not mapping:
+            return
+        try:
+            async with self._client.pipeline(transaction=False) as pipe:
+                for key, value in mapping.items():
+                    pipe.set(
+                        self._prefix + key,
+                        json.dumps(value, default=str),
+                        ex=None if ttl is None else max(1, int(ttl)),
+                    )
+                await pipe.execute()
+        except (self._redis.RedisError, OSError) as e:
+            self._error("set", e)
+
+    async def delete(self, *keys):
+        if not keys:
+            return
+        try:
+            await self._client.delete(*[self._prefix + key for key in keys])
+        except (self._redis.RedisError, OSError) as e:
+            self._error("delete", e)
+
+    async def incr(self, key):
+        # not swallowed here: a lost version bump leaves stale entries
+        # visible to every worker, the caller decides how to handle it
+        return await self._client.incr(self._prefix + key)
+
+    async def close(self):
+        await self._client.aclose()
+
+    def _error(self, operation, e):
+        self._errors += 1
+        logger.warning(f"Cache {operation} failed: {e!r}")
+
+
+# The process-wide cache backend, created on first use.
+_cache = None
+
+
+def get_cache():
+    """
+    Returns the shared cache backend: Redis if CACHE_URL is set (e.g.
+    redis://localhost:6379/0), otherwise an in-memory cache.
+    """
+    global _cache
+
+    if _cache is None:
+        url = os.getenv("CACHE_URL")
+        if url:
+            _cache = RedisCacheBackend(url)
+        else:
+            _cache = MemoryCacheBackend(int(os.getenv("CACHE_SIZE", "10000")))
+    return _cache
+
+
+async def close_cache():
+    global _cache
+
+    if _cache is not None:
+        await _cache.close()
+        _cache = None
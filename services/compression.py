@@ -0,0 +1,82 @@
+import asyncio
+import gzip
+import os
+
+from starlette.datastructures import Headers, MutableHeaders
+
+# Gzip for JSON responses, for clients sending `Accept-Encoding: gzip`.
+# Lists of groups compress to a fraction of their size. Photos are left
+# alone: they are compressed already, and Range responses must be slices
+# of the stored bytes.
+
+# Smaller bodies aren't worth the CPU.
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+# Bigger bodies are compressed in a thread, so the event loop keeps
+# serving other requests meanwhile.
+_THREAD_MIN_SIZE = 256 * 1024
+
+
+class JSONGZipMiddleware:
+    """
+    Compresses complete 200 application/json responses. Unlike Starlette's
+    GZipMiddleware it leaves every other response untouched, and it turns
+    a strong ETag into a weak one, since the compressed bytes differ from
+    the ones the ETag was made for.
+    """
+
+    def __init__(self, app, minimum_size=GZIP_MIN_SIZE, level=GZIP_LEVEL):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or "gzip" not in Headers(scope=scope).get(
+            "accept-encoding", ""
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+
+            if message["type"] == "http.response.start":
+                # held back until the body shows whether to compress
+                start = message
+                return
+            if start is None:
+                await send(message)
+                return
+
+            initial, start = start, None
+            headers = MutableHeaders(raw=initial["headers"])
+            body = message.get("body", b"")
+            if (
+                initial["status"] != 200
+                or message.get("more_body", False)
+                or len(body) < self.minimum_size
+                or "content-encoding" in headers
+                or not headers.get("content-type", "").startswith("application/json")
+            ):
+                await send(initial)
+                await send(message)
+                return
+
+            if len(body) >= _THREAD_MIN_SIZE:
+                body = await asyncio.to_thread(gzip.compress, body, self.level)
+            else:
+                body = gzip.compress(body, self.level)
+
+            headers["Content-Encoding"] = "gzip"
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["ETag"] = f"W/{etag}"
+
+            await send(initial)
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_compressed)
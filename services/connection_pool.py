@@ -0,0 +1,364 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection could be checked out of the pool before
+    the timeout ran out.
+    """
+
+
+class ConnectionPool:
+    """
+    A bounded, thread-safe pool of database connections.
+
+    Connections are created lazily with `connect` up to `max_size`. Once
+    the pool is full, callers wait (up to `timeout` seconds) for another
+    thread to hand a connection back. On checkout every connection is
+    health checked with `ping()`, and connections older than `recycle`
+    seconds are closed and replaced.
+    """
+
+    def __init__(self, connect, max_size=10, timeout=30.0, recycle=3600.0):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (connection, created_at) pairs
+        self._created_at = {}  # connection -> created_at, for checked out ones
+        self._size = 0  # idle + in use
+
+        # counters for stats()
+        self._in_use = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._opened = 0
+        self._closed = 0
+        self._timeouts = 0
+
+    def acquire(self):
+        """
+        Check a connection out of the pool, opening a new one if the pool
+        has room, or waiting for one to be released otherwise.
+        """
+        start = time.monotonic()
+        deadline = start + self.timeout
+        entry = None
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # reserve a slot, the connection is opened outside the lock
+                    self._size += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        f"Timed out after {self.timeout}s waiting for a connection"
+                    )
+                self._cond.wait(remaining)
+
+            waited = time.monotonic() - start
+            if waited > 0.001:
+                self._waits += 1
+                self._wait_time += waited
+            self._in_use += 1
+
+        try:
+            if entry is not None:
+                connection, created_at = entry
+                if self._is_usable(connection, created_at):
+                    self._created_at[connection] = created_at
+                    return connection
+                self._close(connection)
+
+            connection = self._open()
+            self._created_at[connection] = time.monotonic()
+            return connection
+        except BaseException:
+            # give the slot back so a failed connect doesn't shrink the pool
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, connection, discard=False):
+        """
+        Hand a connection back to the pool. Broken connections should be
+        released with `discard=True` so they get closed instead of reused.
+        """
+        created_at = self._created_at.pop(connection, None)
+        if created_at is None:
+            # not one of ours (or already released)
+            return
+
+        if discard:
+            self._close(connection)
+
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append((connection, created_at))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a `with` block.
+
+        If the block raises, any open transaction is rolled back; if even
+        that fails the connection is assumed to be broken and discarded.
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            discard = False
+            try:
+                connection.rollback()
+            except Exception:
+                discard = True
+            self.release(connection, discard=discard)
+            raise
+        else:
+            self.release(connection)
+
+    def close(self):
+        """
+        Close every idle connection. Checked out connections are closed
+        when they are released.
+        """
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+
+        for connection, _ in idle:
+            self._close(connection)
+
+    def stats(self):
+        """
+        Returns a snapshot of the pool's state and counters.
+        """
+        with self._cond:
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "opened": self._opened,
+                "closed": self._closed,
+                "waits": self._waits,
+                "wait_time": round(self._wait_time, 6),
+                "timeouts": self._timeouts,
+            }
+
+    def _is_usable(self, connection, created_at):
+        if self.recycle and time.monotonic() - created_at > self.recycle:
+            return False
+        try:
+            connection.ping(reconnect=False)
+        except Exception:
+            return False
+        return True
+
+    def _open(self):
+        connection = self._connect()
+        with self._cond:
+            self._opened += 1
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._closed += 1
+
+
+class AsyncConnectionPool:
+    """
+    The asyncio counterpart of ConnectionPool, for async drivers whose
+    `connect`, `ping` and `rollback` are coroutines.
+
+    Waiting for a free connection suspends the task instead of blocking
+    the event loop.
+    """
+
+    def __init__(self, connect, max_size=10, timeout=30.0, recycle=3600.0):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+
+        self._cond = asyncio.Condition()
+        self._idle = deque()  # (connection, created_at) pairs
+        self._created_at = {}  # connection -> created_at, for checked out ones
+        self._size = 0  # idle + in use
+
+        # counters for stats()
+        self._in_use = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._opened = 0
+        self._closed = 0
+        self._timeouts = 0
+
+    async def acquire(self):
+        """
+        Check a connection out of the pool, opening a new one if the pool
+        has room, or waiting for one to be released otherwise.
+        """
+        start = time.monotonic()
+        deadline = start + self.timeout
+        entry = None
+
+        async with self._cond:
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # reserve a slot, the connection is opened outside the lock
+                    self._size += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        f"Timed out after {self.timeout}s waiting for a connection"
+                    )
+                try:
+                    await asyncio.wait_for(self._cond.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+            waited = time.monotonic() - start
+            if waited > 0.001:
+                self._waits += 1
+                self._wait_time += waited
+            self._in_use += 1
+
+        try:
+            if entry is not None:
+                connection, created_at = entry
+                if await self._is_usable(connection, created_at):
+                    self._created_at[connection] = created_at
+                    return connection
+                self._close(connection)
+
+            connection = await self._connect()
+            self._opened += 1
+            self._created_at[connection] = time.monotonic()
+            return connection
+        except BaseException:
+            # give the slot back so a failed connect doesn't shrink the pool
+            async with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    async def release(self, connection, discard=False):
+        """
+        Hand a connection back to the pool. Broken connections should be
+        released with `discard=True` so they get closed instead of reused.
+        """
+        created_at = self._created_at.pop(connection, None)
+        if created_at is None:
+            # not one of ours (or already released)
+            return
+
+        if discard:
+            self._close(connection)
+
+        async with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append((connection, created_at))
+            self._cond.notify()
+
+    @asynccontextmanager
+    async def connection(self):
+        """
+        Borrow a connection for the duration of an `async with` block.
+
+        If the block raises, any open transaction is rolled back; if even
+        that fails the connection is assumed to be broken and discarded.
+        """
+        connection = await self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            discard = False
+            try:
+                await connection.rollback()
+            except BaseException:
+                discard = True
+            await self.release(connection, discard=discard)
+            raise
+        else:
+            await self.release(connection)
+
+    async def close(self):
+        """
+        Close every idle connection. Checked out connections are closed
+        when they are released.
+        """
+        async with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+
+        for connection, _ in idle:
+            self._close(connection)
+
+    def stats(self):
+        """
+        Returns a snapshot of the pool's state and counters.
+        """
+        return {
+            "max_size": self.max_size,
+            "size": self._size,
+            "in_use": self._in_use,
+            "idle": len(self._idle),
+            "opened": self._opened,
+            "closed": self._closed,
+            "waits": self._waits,
+            "wait_time": round(self._wait_time, 6),
+            "timeouts": self._timeouts,
+        }
+
+    async def _is_usable(self, connection, created_at):
+        if self.recycle and time.monotonic() - created_at > self.recycle:
+            return False
+        try:
+            await connection.ping(reconnect=False)
+        except Exception:
+            return False
+        return True
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        self._closed += 1
@@ -0,0 +1,24 @@
+import base64
+import json
+
+
+def encode_cursor(key):
+    """
+    Encodes a pagination key (e.g. a group_id) into an opaque, URL-safe
+    cursor token for `after=`/`before=` query parameters.
+    """
+    raw = json.dumps({"k": key}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor token made by `encode_cursor` back into its key.
+
+    Raises ValueError if the token is malformed.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded))["k"]
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
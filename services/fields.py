@@ -0,0 +1,30 @@
+# Partial responses: `?fields=name,group_photo` returns only those fields
+# of a response, and lets the route skip the lookups of the fields that
+# were left out (e.g. the members of a group, one user lookup each).
+
+
+def parse_fields(fields, model, always=()):
+    """
+    Parses the value of a `fields` query parameter into the set of
+    top-level fields of `model` to return, or None (every field) if it is
+    empty. The fields in `always` are returned either way.
+
+    Raises ValueError on fields the model doesn't have.
+    """
+    if not fields:
+        return None
+
+    selected = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = selected - model.model_fields.keys()
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    return frozenset(selected | set(always))
+
+
+def fields_key(selected):
+    """
+    A stable name for a selection of fields, e.g. to cache each partial
+    response separately.
+    """
+    return "all" if selected is None else ",".join(sorted(selected))
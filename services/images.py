@@ -0,0 +1,135 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# Size variants generated for every uploaded group photo, by the longest
+# edge in pixels. They are stored as WebP next to the original.
+VARIANTS = {
+    "thumb": 64,
+    "small": 256,
+    "medium": 512,
+}
+# The original is re-encoded as PNG (dropping its metadata) and scaled
+# down to at most this many pixels along its longest edge.
+ORIGINAL_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "2048"))
+MAX_UPLOAD_BYTES = int(
+    os.getenv("IMAGE_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024))
+)
+MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(40_000_000)))
+WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "80"))
+
+ALLOWED_FORMATS = {"PNG", "JPEG", "WEBP", "GIF"}
+
+# Worker processes doing the CPU-heavy image work.
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+
+class InvalidImage(Exception):
+    """
+    Raised when an upload isn't an image we accept.
+    """
+
+
+def variant_name(name, variant):
+    """
+    The object name of a size variant of a photo, e.g.
+    groups/1_photo.png -> groups/1_photo_thumb.webp
+    """
+    if variant == "original":
+        return name
+    stem = os.path.splitext(name)[0]
+    return f"{stem}_{variant}.webp"
+
+
+def _open(data):
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise InvalidImage(f"Image is larger than {MAX_UPLOAD_BYTES} bytes")
+
+    try:
+        # verify() checks the file's integrity but leaves the image
+        # unusable, so it has to be opened a second time
+        with Image.open(BytesIO(data)) as image:
+            image.verify()
+        image = Image.open(BytesIO(data))
+    except Exception as e:
+        raise InvalidImage(f"Not a valid image: {e}")
+
+    if image.format not in ALLOWED_FORMATS:
+        raise InvalidImage(f"Unsupported image format: {image.format}")
+    if image.width * image.height > MAX_PIXELS:
+        raise InvalidImage("Image has too many pixels")
+
+    return image
+
+
+def _encode(image, max_edge, format, **options):
+    image = image.copy()
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    out = BytesIO()
+    # nothing but the pixels is written, so EXIF/GPS/ICC metadata is dropped
+    image.save(out, format=format, **options)
+    return out.getvalue()
+
+
+def process_image(data):
+    """
+    Validates an uploaded image and renders the stored original (PNG) and
+    every size variant (WebP) from it, all stripped of metadata.
+
+    Returns a dict of variant -> encoded bytes, including "original".
+    CPU heavy, run it through `process_image_async`.
+    """
+    image = _open(data)
+
+    # apply the EXIF rotation before the EXIF data is dropped
+    image = ImageOps.exif_transpose(image)
+    has_alpha = "A" in image.getbands() or "transparency" in image.info
+    image = image.convert("RGBA" if has_alpha else "RGB")
+
+    rendered = {"original": _encode(image, ORIGINAL_MAX_EDGE, "PNG", optimize=True)}
+    for variant, max_edge in VARIANTS.items():
+        rendered[variant] = _encode(image, max_edge, "WEBP", quality=WEBP_QUALITY)
+
+    return rendered
+
+
+# The process pool, created on first use.
+_executor = None
+_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                # spawn instead of fork, the server process has threads running
+                _executor = ProcessPoolExecutor(
+                    max_workers=IMAGE_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+    return _executor
+
+
+async def process_image_async(data):
+    """
+    Runs `process_image` in the image worker processes, so the CPU work
+    neither blocks the event loop nor holds the GIL of the server.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), process_image, data)
+
+
+def shutdown_images():
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,412 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from contextvars import ContextVar
+
+from services.async_sql_comands import AsyncSQLMachine
+
+# Work that is too slow to do while the client waits (e.g. creating a group
+# with many members) runs as a job: the request stores it in the jobs table
+# and returns 202 with a status URL, and worker tasks of this process pick
+# it up from a bounded in-memory queue. Jobs left unfinished by a restart
+# are queued again on startup from the table (created by migration 2, see
+# services/migrations.py).
+#
+# Job rows are always read from the primary, a read replica could still
+# show a job as queued after it finished.
+#
+# Several instances share the table, so a job only runs once a worker
+# claimed it with a conditional UPDATE, which exactly one of them wins.
+# The claim is a lease on the job (owner, lease_until), renewed while the
+# job runs; jobs whose lease ran out, e.g. because their instance died,
+# are picked up again by the other instances. A job can still run twice
+# if its instance stalls for longer than the lease, so handlers have to
+# be idempotent (see current_job_id).
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "1000"))
+# Attempts per job before it is marked as failed, and the delay before the
+# first retry (doubled on every further one).
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "1"))
+# Seconds a claimed job belongs to its instance without a renewal. Also how
+# often every instance looks for jobs whose lease ran out. The instances'
+# clocks must agree to well within this.
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# kind -> coroutine function taking the payload and returning the result,
+# both JSON serializable
+_handlers = {}
+
+# Takes a job that is queued, or running with a lease that ran out.
+CLAIM_SQL = """
+UPDATE group_service_db.jobs
+SET status = %s, owner = %s, lease_until = %s, attempts = attempts + 1
+WHERE job_id = %s
+    AND (status = %s OR (status = %s AND (lease_until IS NULL OR lease_until < %s)))
+"""
+
+# Unfinished jobs no instance holds a lease on.
+UNCLAIMED_SQL = """
+SELECT job_id FROM group_service_db.jobs
+WHERE status IN (%s, %s) AND (lease_until IS NULL OR lease_until < %s)
+ORDER BY created_at
+"""
+
+_current_job = ContextVar("current_job", default=None)
+
+
+def current_job_id():
+    """
+    The id of the job the calling handler runs for, e.g. to record what an
+    earlier, interrupted attempt already did.
+    """
+    return _current_job.get()
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted while the queue is full.
+    """
+
+
+class PermanentJobError(Exception):
+    """
+    Raised by a job handler for failures that retrying won't fix, e.g. an
+    unknown member email. The job fails right away.
+    """
+
+
+def job_handler(kind):
+    """
+    Registers the decorated coroutine function as the handler of a kind of
+    job.
+    """
+
+    def register(func):
+        _handlers[kind] = func
+        return func
+
+    return register
+
+
+class JobQueue:
+    """
+    A bounded queue of job ids with a fixed number of worker tasks. The
+    state of every job lives in the jobs table, the queue only decides
+    which job runs next.
+    """
+
+    def __init__(
+        self,
+        workers=JOB_WORKERS,
+        max_size=JOB_QUEUE_SIZE,
+        max_attempts=JOB_MAX_ATTEMPTS,
+        retry_delay=JOB_RETRY_DELAY,
+        lease=JOB_LEASE_SECONDS,
+    ):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+        # names this queue's leases in the jobs table
+        self.owner = f"{socket.gethostname()[:32]}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._queued = set()  # job ids in the queue
+        self._tasks = []
+
+        self._succeeded = 0
+        self._failed = 0
+        self._retries = 0
+
+    def _start(self):
+        # workers are started on first use, inside the running event loop,
+        # in a context of their own so they don't inherit the contextvars
+        # (e.g. the query tracker) of the request that started them
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._worker(), context=contextvars.Context())
+                for _ in range(self.workers)
+            ]
+            self._tasks.append(
+                asyncio.create_task(self._sweep(), context=contextvars.Context())
+            )
+
+    def _put(self, job_id):
+        # raises asyncio.QueueFull
+        if job_id not in self._queued:
+            self._queue.put_nowait(job_id)
+            self._queued.add(job_id)
+
+    async def submit(self, kind, payload):
+        """
+        Stores a new job and queues it. Returns the job's id.
+
+        Raises QueueFull if the queue has no room, the job isn't stored
+        then and the caller can do the work itself.
+        """
+        if self._queue.full():
+            raise QueueFull(f"The job queue is full ({self._queue.maxsize} jobs)")
+
+        sql = AsyncSQLMachine()
+        job_id = uuid.uuid4().hex
+        await sql.insert(
+            "group_service_db",
+            "jobs",
+            {
+                "job_id": job_id,
+                "kind": kind,
+                "status": QUEUED,
+                "payload": json.dumps(payload),
+                "attempts": 0,
+                # held for this queue until it is due to run
+                "owner": self.owner,
+                "lease_until": time.time() + self.lease,
+            },
+        )
+
+        try:
+            self._put(job_id)
+        except asyncio.QueueFull:
+            # filled up while the job was being stored
+            await sql.delete("group_service_db", "jobs", {"job_id": job_id})
+            raise QueueFull(f"The job queue is full ({self._queue.maxsize} jobs)")
+
+        self._start()
+        return job_id
+
+    async def recover(self):
+        """
+        Queues the unfinished jobs no instance holds a lease on, e.g. the
+        ones a previous run left behind. Returns the number of jobs queued.
+        """
+        rows = await AsyncSQLMachine(primary=True).execute(
+            UNCLAIMED_SQL, (QUEUED, RUNNING, time.time())
+        )
+
+        queued = 0
+        for (job_id,) in rows:
+            try:
+                self._put(job_id)
+            except asyncio.QueueFull:
+                logger.warning(
+                    f"Job queue full, {len(rows) - queued} unfinished jobs left"
+                )
+                break
+            queued += 1
+
+        if queued:
+            self._start()
+        return queued
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            self._queued.discard(job_id)
+            try:
+                await self._run(job_id)
+            except Exception:
+                logger.exception(f"Job {job_id} crashed")
+            finally:
+                self._queue.task_done()
+
+    async def _sweep(self):
+        # takes over the jobs of instances that stopped renewing their lease
+        while True:
+            await asyncio.sleep(self.lease)
+            try:
+                await self.recover()
+            except Exception:
+                logger.exception("Could not look for abandoned jobs")
+
+    async def _claim(self, job_id):
+        now = time.time()
+        claimed = await AsyncSQLMachine().execute(
+            CLAIM_SQL,
+            (RUNNING, self.owner, now + self.lease, job_id, QUEUED, RUNNING, now),
+            result="rowcount",
+        )
+        return claimed == 1
+
+    async def _renew(self, job_id):
+        # keeps the lease while the job runs, including its retries
+        sql = AsyncSQLMachine()
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                renewed = await sql.update(
+                    "group_service_db",
+                    "jobs",
+                    {"lease_until": time.time() + self.lease},
+                    {"job_id": job_id, "owner": self.owner},
+                )
+            except Exception:
+                logger.exception(f"Could not renew the lease of job {job_id}")
+                continue
+            if not renewed:
+                logger.warning(f"Job {job_id} was taken over by another instance")
+                return
+
+    async def _run(self, job_id):
+        # only the instance whose claim succeeds runs the job
+        if not await self._claim(job_id):
+            return
+
+        rows = await AsyncSQLMachine(primary=True).select(
+            "group_service_db", "jobs", {"job_id": job_id}
+        )
+        if not rows:
+            return
+        job = rows[0]
+
+        handler = _handlers.get(job.kind)
+        if handler is None:
+            await self._finish(job_id, FAILED, error=f"Unknown job kind: {job.kind}")
+            return
+
+        renewal = asyncio.create_task(self._renew(job_id))
+        token = _current_job.set(job_id)
+        try:
+            await self._attempt(job, handler)
+        finally:
+            _current_job.reset(token)
+            renewal.cancel()
+
+    async def _attempt(self, job, handler):
+        payload = json.loads(job.payload)
+        attempts = job.attempts  # this attempt was counted by the claim
+        while True:
+            try:
+                result = await handler(payload)
+            except Exception as e:
+                if isinstance(e, PermanentJobError) or attempts >= self.max_attempts:
+                    logger.warning(f"Job {job.job_id} ({job.kind}) failed: {e!r}")
+                    await self._finish(job.job_id, FAILED, error=str(e))
+                    return
+
+                self._retries += 1
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                logger.info(
+                    f"Job {job.job_id} ({job.kind}) failed, retrying in {delay}s: {e!r}"
+                )
+                await asyncio.sleep(delay)
+
+                attempts += 1
+                still_ours = await AsyncSQLMachine().update(
+                    "group_service_db",
+                    "jobs",
+                    {"attempts": attempts, "lease_until": time.time() + self.lease},
+                    {"job_id": job.job_id, "owner": self.owner},
+                )
+                if not still_ours:
+                    return
+                continue
+
+            await self._finish(job.job_id, SUCCEEDED, result=json.dumps(result))
+            return
+
+    async def _finish(self, job_id, status, result=None, error=None):
+        finished = await AsyncSQLMachine().update(
+            "group_service_db",
+            "jobs",
+            {"status": status, "result": result, "error": error, "lease_until": None},
+            {"job_id": job_id, "owner": self.owner},
+        )
+        if not finished:
+            # another instance took the job over meanwhile and finishes it
+            return
+
+        if status == SUCCEEDED:
+            self._succeeded += 1
+        else:
+            self._failed += 1
+
+    async def close(self):
+        """
+        Stops the workers. Jobs still queued or running stay so in the
+        table, and their leases are given up so that another instance, or
+        `recover` on the next start, takes them over right away.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        try:
+            await AsyncSQLMachine().update(
+                "group_service_db",
+                "jobs",
+                {"lease_until": None},
+                {"owner": self.owner, "status": [QUEUED, RUNNING]},
+            )
+        except Exception:
+            logger.exception("Could not give up the leases of the unfinished jobs")
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "max_size": self._queue.maxsize,
+            "workers": len(self._tasks),
+            "succeeded": self._succeeded,
+            "failed": self._failed,
+            "retries": self._retries,
+        }
+
+
+# The process-wide job queue, created on first use inside the running
+# event loop.
+_job_queue = None
+
+
+def get_job_queue():
+    global _job_queue
+
+    if _job_queue is None:
+        _job_queue = JobQueue()
+    return _job_queue
+
+
+async def start_jobs():
+    """
+    Queues the jobs left unfinished by a previous run, called on startup.
+    """
+    try:
+        queued = await get_job_queue().recover()
+    except Exception:
+        # the service still works without it, just not asynchronously
+        logger.exception("Could not recover the job queue")
+        return
+
+    if queued:
+        logger.info(f"Queued {queued} unfinished jobs")
+
+
+async def close_job_queue():
+    global _job_queue
+
+    if _job_queue is not None:
+        await _job_queue.close()
+        _job_queue = None
+
+
+async def get_job(job_id):
+    """
+    Returns the Job row with this id, or None if there is none.
+    """
+    rows = await AsyncSQLMachine(primary=True).select(
+        "group_service_db", "jobs", {"job_id": job_id}
+    )
+    return rows[0] if rows else None
@@ -0,0 +1,185 @@
+import re
+import time
+from functools import lru_cache
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import REGISTRY
+
+from services.query_tracker import record_query
+
+# Prometheus metrics of the service, served by GET /metrics. Everything is
+# timed with time.perf_counter(), a monotonic clock.
+#
+# Requests are labelled by route template (/groups/{group_id}), never by
+# the raw path, so the number of series stays bounded.
+
+_FAST_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5
+)
+
+REQUEST_LATENCY = Histogram(
+    "group_service_request_duration_seconds",
+    "Time to respond to an HTTP request, by route template.",
+    ["method", "route", "status"],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "group_service_requests_in_progress",
+    "HTTP requests being handled right now.",
+)
+QUERY_LATENCY = Histogram(
+    "group_service_db_query_duration_seconds",
+    "Time to run a database statement, by operation and table.",
+    ["operation", "table"],
+    buckets=_FAST_BUCKETS,
+)
+QUERY_ERRORS = Counter(
+    "group_service_db_query_errors_total",
+    "Database statements that raised, by operation and table.",
+    ["operation", "table"],
+)
+DB_READS = Counter(
+    "group_service_db_reads_total",
+    "Read statements, by where they ran (primary or replica).",
+    ["target"],
+)
+REPLICA_EJECTIONS = Counter(
+    "group_service_db_replica_ejections_total",
+    "Times a read replica was taken out of rotation after failing.",
+    ["replica"],
+)
+STORAGE_LATENCY = Histogram(
+    "group_service_storage_call_duration_seconds",
+    "Time spent in a blocking storage call, by call.",
+    ["call"],
+    buckets=_FAST_BUCKETS,
+)
+
+
+def route_label(scope):
+    """
+    The route template a request matched, or "unmatched" (e.g. for 404s).
+    """
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+def observe_request(method, route, status, duration):
+    REQUEST_LATENCY.labels(method, route, str(status)).observe(duration)
+
+
+_TABLE_PATTERN = re.compile(
+    r"\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+([\w.]+)",
+    re.IGNORECASE,
+)
+
+
+@lru_cache(maxsize=1024)
+def _query_labels(query):
+    # statements come from the query builder, so there are only a few
+    # distinct ones and each is parsed once
+    operation = query.split(None, 1)[0].lower() if query.strip() else ""
+    match = _TABLE_PATTERN.search(query)
+    return operation, match.group(1) if match else ""
+
+
+class timed_query:
+    """
+    Times a database statement, use as `with timed_query(query):`. The
+    statement is also counted towards the current request's query
+    tracker (see services/query_tracker.py).
+    """
+
+    __slots__ = ("query", "labels", "start")
+
+    def __init__(self, query):
+        self.query = query
+        self.labels = _query_labels(query)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        QUERY_LATENCY.labels(*self.labels).observe(duration)
+        if exc_type is not None:
+            QUERY_ERRORS.labels(*self.labels).inc()
+        record_query(self.query, duration)
+
+
+def timed_storage_call(func, *args):
+    """
+    Calls a blocking storage function and records how long it took.
+    """
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        name = getattr(func, "__name__", "call")
+        STORAGE_LATENCY.labels(name).observe(time.perf_counter() - start)
+
+
+class _PoolCollector:
+    """
+    Reports the state of the connection pools at scrape time, from their
+    own counters, so acquiring a connection costs nothing extra.
+    """
+
+    def __init__(self):
+        self.pools = {}
+
+    def collect(self):
+        connections = GaugeMetricFamily(
+            "group_service_db_pool_connections",
+            "Pooled database connections, by state.",
+            labels=["pool", "state"],
+        )
+        counters = {
+            "opened": CounterMetricFamily(
+                "group_service_db_pool_opened",
+                "Database connections opened.",
+                labels=["pool"],
+            ),
+            "closed": CounterMetricFamily(
+                "group_service_db_pool_closed",
+                "Database connections closed.",
+                labels=["pool"],
+            ),
+            "waits": CounterMetricFamily(
+                "group_service_db_pool_waits",
+                "Times a query had to wait for a free connection.",
+                labels=["pool"],
+            ),
+            "wait_time": CounterMetricFamily(
+                "group_service_db_pool_wait_seconds",
+                "Time spent waiting for a free connection.",
+                labels=["pool"],
+            ),
+            "timeouts": CounterMetricFamily(
+                "group_service_db_pool_timeouts",
+                "Times no connection became free in time.",
+                labels=["pool"],
+            ),
+        }
+
+        for name, pool in list(self.pools.items()):
+            stats = pool.stats()
+            connections.add_metric([name, "in_use"], stats["in_use"])
+            connections.add_metric([name, "idle"], stats["idle"])
+            for key, metric in counters.items():
+                metric.add_metric([name], stats[key])
+
+        yield connections
+        yield from counters.values()
+
+
+_pool_collector = _PoolCollector()
+REGISTRY.register(_pool_collector)
+
+
+def register_pool(name, pool):
+    """
+    Adds a connection pool ("sync", "async" or a replica's) to the pool
+    metrics.
+    """
+    _pool_collector.pools[name] = pool
@@ -0,0 +1,252 @@
+import logging
+import os
+import sys
+
+from services.sql_comands import SQLMachine, get_pool
+
+# The schema of group_service_db, as an ordered list of migrations. Every
+# migration runs once per database; the versions that ran are recorded in
+# group_service_db.schema_migrations. Add new migrations at the end with
+# the next version, never edit one that was released.
+#
+# MySQL commits DDL statements implicitly, so a migration that fails
+# halfway is not rolled back and has to be finished by hand before the
+# next start.
+
+logger = logging.getLogger(__name__)
+
+# Apply the pending migrations on startup, turn off when they are run
+# separately (`python -m services.migrations`) before a deploy.
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "1").lower() in ("1", "true")
+# Seconds to wait for another instance that is migrating the same database.
+MIGRATION_LOCK_TIMEOUT = int(os.getenv("MIGRATION_LOCK_TIMEOUT", "60"))
+
+MIGRATION_LOCK = "group_service_db.schema_migrations"
+
+MIGRATIONS_TABLE_DDL = """
+CREATE TABLE IF NOT EXISTS group_service_db.schema_migrations (
+    version INT NOT NULL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+
+def _delete_duplicate_members(sql):
+    # the rows have no key to tell copies apart, so every membership that
+    # is there more than once loses all but one of its rows
+    duplicates = sql.execute(
+        """
+        SELECT group_id, user_id, COUNT(*) FROM group_service_db.group_members
+        GROUP BY group_id, user_id
+        HAVING COUNT(*) > 1
+        """
+    )
+    for group_id, user_id, count in duplicates:
+        sql.execute(
+            """
+            DELETE FROM group_service_db.group_members
+            WHERE group_id = %s AND user_id = %s
+            LIMIT %s
+            """,
+            (group_id, user_id, count - 1),
+        )
+
+
+# Counts the members of the groups whose member_count is still 0, e.g.
+# because an instance that didn't write it yet created them.
+BACKFILL_MEMBER_COUNTS = """
+UPDATE group_service_db.groups
+SET member_count = (
+    SELECT COUNT(*) FROM group_service_db.group_members m
+    WHERE m.group_id = group_service_db.groups.group_id
+)
+WHERE member_count = 0
+"""
+
+# (version, name, steps), every step is a statement or a function taking
+# the SQLMachine, for steps that need more than one statement
+MIGRATIONS = [
+    (
+        1,
+        "create groups and group_members",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS group_service_db.groups (
+                group_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                group_name VARCHAR(255) NOT NULL,
+                group_photo VARCHAR(1024) NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS group_service_db.group_members (
+                group_id INT NOT NULL,
+                user_id VARCHAR(64) NOT NULL
+            )
+            """,
+        ],
+    ),
+    (
+        2,
+        "create jobs",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS group_service_db.jobs (
+                job_id CHAR(32) NOT NULL PRIMARY KEY,
+                kind VARCHAR(64) NOT NULL,
+                status VARCHAR(16) NOT NULL,
+                payload TEXT NOT NULL,
+                result TEXT NULL,
+                error TEXT NULL,
+                attempts INT NOT NULL DEFAULT 0,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    ON UPDATE CURRENT_TIMESTAMP,
+                INDEX jobs_status (status, created_at)
+            )
+            """,
+        ],
+    ),
+    (
+        # Looking up a user's groups and a group's members both used to
+        # scan the whole table. Duplicate memberships are deleted in place,
+        # since the unique index can't be added while there are any, and
+        # both indexes are added online: instances still running the old
+        # code keep reading and writing the table meanwhile. If one of them
+        # adds a duplicate in between, the ALTER fails and the migration
+        # is simply run again.
+        3,
+        "index group_members by group and by user",
+        [
+            _delete_duplicate_members,
+            """
+            ALTER TABLE group_service_db.group_members
+                ADD UNIQUE INDEX group_members_group_user (group_id, user_id),
+                ADD INDEX group_members_user_group (user_id, group_id),
+                ALGORITHM=INPLACE, LOCK=NONE
+            """,
+        ],
+    ),
+    (
+        # The number of members of every group, written with the group,
+        # so lists of groups don't have to count the group_members rows.
+        4,
+        "add groups.member_count",
+        [
+            """
+            ALTER TABLE group_service_db.groups
+                ADD COLUMN member_count INT NOT NULL DEFAULT 0
+            """,
+            """
+            UPDATE group_service_db.groups g
+            SET member_count = (
+                SELECT COUNT(*) FROM group_service_db.group_members m
+                WHERE m.group_id = g.group_id
+            )
+            """,
+        ],
+    ),
+    (
+        # The lease of the instance running a job, see services/jobs.py.
+        5,
+        "add jobs.owner and jobs.lease_until",
+        [
+            """
+            ALTER TABLE group_service_db.jobs
+                ADD COLUMN owner VARCHAR(64) NULL,
+                ADD COLUMN lease_until DOUBLE NULL
+            """,
+        ],
+    ),
+    (
+        # Instances older than migration 4 kept creating groups without a
+        # member_count during the rolling deploy that ran it.
+        #
+        # They may also create some after this ran, if it is part of the
+        # same deploy: once the last of them stopped, run
+        # `python -m services.migrations --backfill-member-counts`.
+        6,
+        "backfill groups.member_count of groups created during the deploy",
+        [BACKFILL_MEMBER_COUNTS],
+    ),
+]
+
+
+class MigrationLockTimeout(Exception):
+    """
+    Raised when another instance holds the migration lock for longer than
+    MIGRATION_LOCK_TIMEOUT seconds.
+    """
+
+
+def applied_versions(sql):
+    """
+    The versions of the migrations that already ran on the database.
+    """
+    rows = sql.select(
+        "group_service_db", "schema_migrations", columns=("version",)
+    )
+    return {row.version for row in rows}
+
+
+def migrate(lock_timeout=MIGRATION_LOCK_TIMEOUT):
+    """
+    Runs the pending migrations in order and returns their versions.
+
+    A named lock makes instances starting at the same time wait for each
+    other instead of running the same migration twice. The lock belongs
+    to the connection, so everything runs on one.
+    """
+    with get_pool().connection() as connection:
+        sql = SQLMachine(connection)
+
+        locked = sql.execute(
+            "SELECT GET_LOCK(%s, %s)", (MIGRATION_LOCK, lock_timeout), result="one"
+        )
+        if not locked or locked[0] != 1:
+            raise MigrationLockTimeout(
+                f"Another instance is still migrating after {lock_timeout}s"
+            )
+
+        try:
+            sql.execute(MIGRATIONS_TABLE_DDL)
+            applied = applied_versions(sql)
+
+            migrated = []
+            for version, name, steps in MIGRATIONS:
+                if version in applied:
+                    continue
+
+                logger.info(f"Applying migration {version}: {name}")
+                for step in steps:
+                    if callable(step):
+                        step(sql)
+                    else:
+                        sql.execute(step)
+                sql.insert(
+                    "group_service_db",
+                    "schema_migrations",
+                    {"version": version, "name": name},
+                )
+                migrated.append(version)
+
+            return migrated
+        finally:
+            sql.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+
+
+def backfill_member_counts():
+    """
+    Counts the members of the groups whose member_count is still 0 and
+    returns the number of groups updated.
+    """
+    return SQLMachine().execute(BACKFILL_MEMBER_COUNTS, result="rowcount")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if "--backfill-member-counts" in sys.argv[1:]:
+        print(f"Updated the member_count of {backfill_member_counts()} groups")
+    else:
+        versions = migrate()
+        print(f"Applied migrations {versions}" if versions else "Up to date")
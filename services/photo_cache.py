@@ -0,0 +1,285 @@
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from services.storage import CHUNK_SIZE, submit_to_storage_pool
+from services.ttl_cache import TTLCache
+
+# Group photos are streamed from storage the first time they are served
+# and copied to local disk in the background, then served from there.
+# Files live at <PHOTO_CACHE_DIR>/<hash of object name>/<generation>, so a
+# new generation of an object never collides with a stale copy.
+#
+# Every worker process shares the directory. Each keeps a running tally
+# of its size, and rescans the directory every PHOTO_CACHE_RESCAN_SECONDS
+# to count in what the other workers wrote. A file's mtime is its last
+# use, touched on every hit.
+
+logger = logging.getLogger(__name__)
+
+PHOTO_CACHE_DIR = os.getenv(
+    "PHOTO_CACHE_DIR", os.path.join(tempfile.gettempdir(), "group-service-photos")
+)
+# Total size of the cached files, 0 disables the cache.
+PHOTO_CACHE_MAX_BYTES = int(
+    os.getenv("PHOTO_CACHE_MAX_BYTES", str(512 * 1024 * 1024))
+)
+# How long the storage metadata (size, generation) of an object is trusted.
+PHOTO_STAT_TTL = float(os.getenv("PHOTO_STAT_TTL", "60"))
+# The disk use can exceed PHOTO_CACHE_MAX_BYTES by what the other workers
+# write in this time.
+PHOTO_CACHE_RESCAN_SECONDS = float(os.getenv("PHOTO_CACHE_RESCAN_SECONDS", "60"))
+
+
+def _name_hash(name):
+    return hashlib.sha256(name.encode()).hexdigest()
+
+
+def iter_file_range(path, start, end, chunk_size=CHUNK_SIZE):
+    """
+    Yields the bytes start..end (inclusive) of a file through a memory
+    map, so reads are served straight from the page cache.
+    """
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            position = start
+            while position <= end:
+                next_position = min(position + chunk_size, end + 1)
+                yield mapped[position:next_position]
+                position = next_position
+
+
+class PhotoCache:
+    """
+    A size-bounded, least recently used cache of storage objects on disk.
+    """
+
+    def __init__(self, root=PHOTO_CACHE_DIR, max_bytes=PHOTO_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._files = OrderedDict()  # (name hash, generation) -> size
+        self._bytes = 0
+        self._scanned_at = 0.0
+        self._filling = set()  # keys being copied from storage
+        # object name -> storage BlobInfo, saves a metadata call per request
+        self.blob_info = TTLCache(max_size=4096, ttl=PHOTO_STAT_TTL)
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+        if self.enabled:
+            os.makedirs(self.root, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key):
+        return os.path.join(self.root, *key)
+
+    def _scan(self):
+        # every cached file in the directory, including the other workers',
+        # least recently used first
+        entries = []
+        for name_hash in os.listdir(self.root):
+            directory = os.path.join(self.root, name_hash)
+            if not os.path.isdir(directory):
+                continue
+            try:
+                generations = os.listdir(directory)
+            except FileNotFoundError:
+                continue
+            for generation in generations:
+                if generation.startswith("."):
+                    continue
+                try:
+                    st = os.stat(os.path.join(directory, generation))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, (name_hash, generation), st.st_size))
+
+        return [(key, size) for _, key, size in sorted(entries)]
+
+    def _rescan(self):
+        # caller holds the lock. Rebuilds the index from the directory,
+        # with the files of the other workers and of a previous run.
+        self._files = OrderedDict(self._scan())
+        self._bytes = sum(self._files.values())
+        self._scanned_at = time.monotonic()
+
+    def _load(self):
+        with self._lock:
+            self._rescan()
+            self._evict()
+
+    def get(self, info):
+        """
+        Returns the path of the cached copy of the object described by the
+        storage BlobInfo `info`, or None if it isn't cached.
+        """
+        key = (_name_hash(info.name), info.generation)
+
+        with self._lock:
+            try:
+                # marks it as used for the eviction in every worker; the
+                # file may also have been written or evicted by another one
+                os.utime(self._path(key))
+            except FileNotFoundError:
+                if key in self._files:
+                    self._bytes -= self._files.pop(key)
+                self._misses += 1
+                return None
+
+            if key not in self._files:
+                size = os.path.getsize(self._path(key))
+                self._files[key] = size
+                self._bytes += size
+            self._files.move_to_end(key)
+            self._hits += 1
+            return self._path(key)
+
+    def put(self, info, chunks):
+        """
+        Writes the object's bytes (an iterable of chunks) to the cache and
+        returns the path of the cached file.
+        """
+        key = (_name_hash(info.name), info.generation)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temp file first so readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        size = os.path.getsize(path)
+        with self._lock:
+            if time.monotonic() - self._scanned_at >= PHOTO_CACHE_RESCAN_SECONDS:
+                self._rescan()
+            if key in self._files:
+                self._bytes -= self._files[key]
+            self._files[key] = size
+            self._files.move_to_end(key)
+            self._bytes += size
+            self._evict(keep=key)
+
+        return path
+
+    def fill(self, storage, info):
+        """
+        Copies an object from storage to the cache, unless another thread
+        already does. Errors are only logged, the caller served the object
+        from storage.
+        """
+        key = (_name_hash(info.name), info.generation)
+        with self._lock:
+            if key in self._filling:
+                return
+            self._filling.add(key)
+
+        try:
+            self.put(info, storage.iter_range(info))
+        except Exception:
+            logger.exception(f"Could not cache {info.name}")
+        finally:
+            with self._lock:
+                self._filling.discard(key)
+
+    def invalidate(self, name):
+        """
+        Drops every cached generation of an object, e.g. after it was
+        renamed or deleted.
+        """
+        name_hash = _name_hash(name)
+        self.blob_info.invalidate(name)
+
+        with self._lock:
+            for key in [key for key in self._files if key[0] == name_hash]:
+                self._bytes -= self._files.pop(key)
+
+        shutil.rmtree(os.path.join(self.root, name_hash), ignore_errors=True)
+
+    def _evict(self, keep=None):
+        # caller holds the lock
+        while self._bytes > self.max_bytes and self._files:
+            key, size = next(iter(self._files.items()))
+            if key == keep:
+                # a single object bigger than the whole cache
+                break
+            del self._files[key]
+            self._bytes -= size
+            self._evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
+
+
+# The process-wide photo cache, created on first use.
+_photo_cache = None
+_photo_cache_lock = threading.Lock()
+
+
+def get_photo_cache():
+    global _photo_cache
+
+    if _photo_cache is None:
+        with _photo_cache_lock:
+            if _photo_cache is None:
+                _photo_cache = PhotoCache()
+    return _photo_cache
+
+
+def fetch_photo(storage, name):
+    """
+    Looks an object up through the photo cache. Blocking, call it from a
+    thread.
+
+    Returns (info, path): the object's BlobInfo (None if it doesn't exist)
+    and the path of its cached copy. The path is None on a miss, when the
+    caller streams the object from storage while it is copied to the
+    cache in the background, and if the cache is disabled.
+    """
+    cache = get_photo_cache()
+
+    info = cache.blob_info.get(name, None)
+    if info is None:
+        info = storage.stat(name)
+        if info is None:
+            return None, None
+        cache.blob_info.set(name, info)
+
+    if not cache.enabled:
+        return info, None
+
+    path = cache.get(info)
+    if path is None:
+        submit_to_storage_pool(cache.fill, storage, info)
+    return info, path
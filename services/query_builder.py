@@ -0,0 +1,284 @@
+import os
+from functools import lru_cache
+
+from services.rows import ROW_TYPES
+
+# Builds the SQL of SQLMachine and AsyncSQLMachine. Every builder returns
+# (query, values), or (None, ()) when the conditions can't match any row.
+#
+# Values are always sent as parameters. The statement text only depends on
+# the shape of a query (schema, table, columns, operation), so it is built
+# once per shape and cached. IN lists are padded to a power of two to keep
+# the number of distinct shapes small.
+#
+# Identifiers can't be parameterized, so they are checked against the
+# tables and columns of the row types in services.rows before they ever
+# reach a statement.
+
+KNOWN_TABLES = {table: row._fields for table, row in ROW_TYPES.items()}
+
+STATEMENT_CACHE_SIZE = int(os.getenv("STATEMENT_CACHE_SIZE", "512"))
+
+
+class UnknownIdentifier(ValueError):
+    """
+    Raised when a query names a table or column that isn't known.
+    """
+
+
+def _check(schema, table, columns=()):
+    known = KNOWN_TABLES.get((schema, table))
+    if known is None:
+        raise UnknownIdentifier(f"Unknown table: {schema}.{table}")
+    for column in columns:
+        if column not in known:
+            raise UnknownIdentifier(f"Unknown column: {schema}.{table}.{column}")
+
+
+def _bucket(size):
+    # the next power of two, so IN lists of similar length share a statement
+    return 1 << (size - 1).bit_length()
+
+
+def _where_shape(data):
+    """
+    Splits a dict of column -> value into the shape of its WHERE clause,
+    ((column, IN list size or 0), ...), and the values to send with it.
+    Collection values become `column IN (...)`.
+    """
+    shape = []
+    values = ()
+    for column, value in (data or {}).items():
+        if isinstance(value, (list, tuple, set, frozenset)):
+            if not value:
+                # an empty IN list can't match anything
+                return None, ()
+            value = list(value)
+            size = _bucket(len(value))
+            # repeating a value doesn't change what IN matches
+            value += [value[-1]] * (size - len(value))
+            shape.append((column, size))
+            values += tuple(value)
+        else:
+            shape.append((column, 0))
+            values += (value,)
+
+    return tuple(shape), values
+
+
+def _columns_sql(schema, table, columns):
+    # Every column of the row type rather than `*`: the rows are mapped by
+    # position into a namedtuple of fixed arity, and a column added to a
+    # table (the users table belongs to another service) must not shift or
+    # break them.
+    return ", ".join(KNOWN_TABLES[(schema, table)] if columns is None else columns)
+
+
+def _where_sql(shape):
+    conditions = []
+    for column, size in shape:
+        if size:
+            placeholders = ", ".join(["%s"] * size)
+            conditions.append(f"{column} IN ({placeholders})")
+        else:
+            conditions.append(f"{column} = %s")
+
+    return " AND ".join(conditions)
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _select_sql(schema, table, columns, shape, order_by, has_limit, has_offset):
+    _check(schema, table, [*(columns or ()), *[column for column, _ in shape]])
+
+    query = f"SELECT {_columns_sql(schema, table, columns)} FROM {schema}.{table}"
+    if shape:
+        query += f" WHERE {_where_sql(shape)}"
+    if order_by is not None:
+        column, _, direction = order_by.partition(" ")
+        _check(schema, table, [column])
+        if direction.upper() not in ("", "ASC", "DESC"):
+            raise UnknownIdentifier(f"Invalid order: {order_by}")
+        query += f" ORDER BY {order_by}"
+    if has_limit:
+        query += " LIMIT %s"
+        if has_offset:
+            query += " OFFSET %s"
+
+    return query
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _keyset_sql(schema, table, columns, key, shape, bound):
+    _check(schema, table, [*(columns or ()), key, *[column for column, _ in shape]])
+
+    conditions = [_where_sql(shape)] if shape else []
+    if bound == "before":
+        conditions.append(f"{key} < %s")
+        direction = "DESC"
+    else:
+        if bound == "after":
+            conditions.append(f"{key} > %s")
+        direction = "ASC"
+
+    query = f"SELECT {_columns_sql(schema, table, columns)} FROM {schema}.{table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    # fetch one extra row to know whether there is another page
+    query += f" ORDER BY {key} {direction} LIMIT %s"
+
+    return query
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _count_sql(schema, table, shape):
+    _check(schema, table, [column for column, _ in shape])
+
+    query = f"SELECT COUNT(*) FROM {schema}.{table}"
+    if shape:
+        query += f" WHERE {_where_sql(shape)}"
+
+    return query
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _insert_sql(schema, table, columns, rows):
+    _check(schema, table, columns)
+
+    row_placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    placeholders = ", ".join([row_placeholders] * rows)
+
+    return f"INSERT INTO {schema}.{table} ({', '.join(columns)}) VALUES {placeholders}"
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _delete_sql(schema, table, shape):
+    _check(schema, table, [column for column, _ in shape])
+
+    query = f"DELETE FROM {schema}.{table}"
+    if shape:
+        query += f" WHERE {_where_sql(shape)}"
+
+    return query
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _update_sql(schema, table, columns, shape):
+    _check(schema, table, [*columns, *[column for column, _ in shape]])
+
+    # Create the SET clause for update_data
+    set_clause = ", ".join([f"{column} = %s" for column in columns])
+
+    return f"UPDATE {schema}.{table} SET {set_clause} WHERE {_where_sql(shape)}"
+
+
+def _projection(columns):
+    # None selects every column
+    return None if columns is None else tuple(columns)
+
+
+def build_select(
+    schema, table, data=None, order_by=None, limit=None, offset=None, columns=None
+):
+    shape, values = _where_shape(data)
+    if shape is None:
+        return None, ()
+
+    query = _select_sql(
+        schema,
+        table,
+        _projection(columns),
+        shape,
+        order_by,
+        limit is not None,
+        bool(offset),
+    )
+    if limit is not None:
+        values += (limit,)
+        if offset:
+            values += (offset,)
+
+    return query, values
+
+
+def build_keyset(
+    schema, table, key, limit, after=None, before=None, data=None, columns=None
+):
+    shape, values = _where_shape(data)
+    if shape is None:
+        return None, ()
+
+    if before is not None:
+        bound = "before"
+        values += (before,)
+    elif after is not None:
+        bound = "after"
+        values += (after,)
+    else:
+        bound = None
+
+    query = _keyset_sql(schema, table, _projection(columns), key, shape, bound)
+
+    return query, values + (limit + 1,)
+
+
+def build_count(schema, table, data=None):
+    shape, values = _where_shape(data)
+    if shape is None:
+        return None, ()
+
+    return _count_sql(schema, table, shape), values
+
+
+def build_insert(schema, table, data):
+    query = _insert_sql(schema, table, tuple(data.keys()), 1)
+
+    return query, tuple(data.values())
+
+
+def build_insert_many(schema, table, rows):
+    """
+    Builds one multi-row INSERT for a list of dicts sharing the same keys.
+    """
+    columns = tuple(rows[0].keys())
+    query = _insert_sql(schema, table, columns, len(rows))
+    values = tuple(row[column] for row in rows for column in columns)
+
+    return query, values
+
+
+def build_delete(schema, table, data=None):
+    shape, values = _where_shape(data)
+    if shape is None:
+        return None, ()
+
+    return _delete_sql(schema, table, shape), values
+
+
+def build_update(schema, table, update_data, conditions):
+    shape, where_values = _where_shape(conditions)
+    if shape is None:
+        return None, ()
+    if not shape:
+        raise ValueError("An update needs at least one condition")
+
+    query = _update_sql(schema, table, tuple(update_data.keys()), shape)
+
+    # Combine the values from update_data and conditions into a single tuple
+    return query, tuple(update_data.values()) + where_values
+
+
+def statement_cache_stats():
+    """
+    Returns the hit/miss counters of the statement caches.
+    """
+    return {
+        func.__name__.strip("_"): func.cache_info()._asdict()
+        for func in (
+            _select_sql,
+            _keyset_sql,
+            _count_sql,
+            _insert_sql,
+            _delete_sql,
+            _update_sql,
+        )
+    }
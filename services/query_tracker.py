@@ -0,0 +1,135 @@
+import logging
+import os
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Counts the database statements of the current request: how many ran,
+# how long they took together and how often each statement was repeated.
+# A statement repeated many times in one request is usually an N+1 query
+# (one query per item of a list) that should be a single batched query.
+#
+# The tracker lives in a contextvar, so it follows the request into the
+# tasks and threads it awaits without being passed around.
+
+logger = logging.getLogger(__name__)
+
+# Most statements a request should need, 0 disables the check.
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", "25"))
+# How often one statement may run in a request before it's reported.
+QUERY_REPEAT_THRESHOLD = int(os.getenv("QUERY_REPEAT_THRESHOLD", "5"))
+# Raise instead of logging, meant for tests and CI.
+QUERY_BUDGET_STRICT = os.getenv("QUERY_BUDGET_STRICT", "").lower() in ("1", "true")
+# Statements slower than this are logged as warnings, every statement is
+# logged at DEBUG level.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+
+_current = ContextVar("query_tracker", default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised in strict mode when a request runs more statements than its
+    budget allows.
+    """
+
+
+class QueryTracker:
+    __slots__ = ("count", "db_time", "statements", "budget", "strict")
+
+    def __init__(self, budget=QUERY_BUDGET, strict=QUERY_BUDGET_STRICT):
+        self.count = 0
+        self.db_time = 0.0
+        self.statements = Counter()  # statement text -> times it ran
+        self.budget = budget
+        self.strict = strict
+
+    def record(self, query, duration):
+        self.count += 1
+        self.db_time += duration
+        self.statements[query] += 1
+
+        if self.strict and self.over_budget:
+            raise QueryBudgetExceeded(
+                f"{self.count} queries, the budget is {self.budget}"
+            )
+
+    @property
+    def over_budget(self):
+        return 0 < self.budget < self.count
+
+    def repeated(self, threshold=QUERY_REPEAT_THRESHOLD):
+        """
+        The statements that ran at least `threshold` times, with counts.
+        """
+        return {
+            query: count
+            for query, count in self.statements.items()
+            if count >= threshold
+        }
+
+    def server_timing(self, total=None):
+        """
+        The value of a Server-Timing header, e.g.
+        `db;dur=12.3;desc="4 queries", total;dur=20.1`.
+        """
+        timing = f'db;dur={self.db_time * 1000:.1f};desc="{self.count} queries"'
+        if total is not None:
+            timing += f", total;dur={total * 1000:.1f}"
+        return timing
+
+    def report(self, name):
+        """
+        Logs the statements repeated too often and an exceeded budget of
+        the request `name`.
+        """
+        for query, count in self.repeated().items():
+            logger.warning(f"Possible N+1 query in {name}: {count}x {query}")
+
+        if self.over_budget:
+            message = f"{name} ran {self.count} queries, the budget is {self.budget}"
+            if self.strict:
+                logger.error(message)
+            else:
+                logger.warning(message)
+
+
+def current_tracker():
+    """
+    The tracker of the current request, or None outside of one.
+    """
+    return _current.get()
+
+
+def record_query(query, duration):
+    duration_ms = duration * 1000
+    if duration_ms >= SLOW_QUERY_MS:
+        logger.warning(
+            "slow query",
+            extra={"query": query, "duration_ms": round(duration_ms, 2)},
+        )
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "query", extra={"query": query, "duration_ms": round(duration_ms, 2)}
+        )
+
+    tracker = _current.get()
+    if tracker is not None:
+        tracker.record(query, duration)
+
+
+@contextmanager
+def track_queries(budget=QUERY_BUDGET, strict=QUERY_BUDGET_STRICT):
+    """
+    Tracks the statements run inside the block:
+
+        with track_queries(budget=3, strict=True) as tracker:
+            ...
+        assert tracker.count <= 3
+    """
+    tracker = QueryTracker(budget, strict)
+    token = _current.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _current.reset(token)
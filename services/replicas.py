@@ -0,0 +1,161 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import pymysql
+
+from services.connection_pool import PoolTimeout
+from services.metrics import REPLICA_EJECTIONS
+
+# Reads (SQLMachine.select, select_paginated, select_keyset and count) are
+# spread round-robin over the read replicas in DATABASE_REPLICAS; every
+# other statement goes to the primary at DATABASE_IP. A replica that
+# fails is ejected for a while and its reads go to the primary instead.
+#
+# Replicas lag behind the primary, so once a request wrote anything, its
+# later reads go to the primary too and it always sees its own writes.
+# Other requests may still read the old rows for as long as the replica
+# lags; rows that must never be stale, and rows that fill a cache shared
+# with other requests, are read with SQLMachine(primary=True).
+
+logger = logging.getLogger(__name__)
+
+
+def parse_replicas(value, default_port):
+    """
+    Parses "host[:port],host[:port]..." into a list of (host, port).
+    """
+    replicas = []
+    for entry in (value or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.partition(":")
+        replicas.append((host, int(port) if port else default_port))
+    return replicas
+
+
+# Read replicas, same credentials as the primary. Empty: no replicas.
+DATABASE_REPLICAS = parse_replicas(
+    os.getenv("DATABASE_REPLICAS"), int(os.getenv("DATABASE_PORT", "3306"))
+)
+# Seconds a failed replica gets no reads, doubled on every further failure
+# in a row (at most 8x).
+REPLICA_EJECT_SECONDS = float(os.getenv("REPLICA_EJECT_SECONDS", "30"))
+
+# Errors that mean the replica itself is unusable, not the statement.
+CONNECTION_ERRORS = (
+    pymysql.err.OperationalError,
+    pymysql.err.InterfaceError,
+    PoolTimeout,
+    OSError,
+)
+
+
+class Replica:
+    __slots__ = ("name", "pool", "failures", "ejected_until")
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.failures = 0  # in a row
+        self.ejected_until = 0.0
+
+
+class ReplicaSet:
+    """
+    The read replicas of one kind of pool (sync or async), handed out
+    round-robin, skipping the ejected ones.
+
+    Health is checked on the way: the pool pings every idle connection
+    before reusing it, and a replica whose connection or read fails is
+    ejected. Once the ejection ran out it gets reads again; if the first
+    one fails it is ejected again, for longer.
+    """
+
+    def __init__(self, replicas, eject_for=REPLICA_EJECT_SECONDS):
+        self.replicas = replicas
+        self.eject_for = eject_for
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def choose(self):
+        """
+        The replica for the next read, or None if every replica is
+        ejected (or there are none) and it has to go to the primary.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self.replicas)):
+                replica = self.replicas[self._next]
+                self._next = (self._next + 1) % len(self.replicas)
+                if replica.ejected_until <= now:
+                    return replica
+        return None
+
+    def eject(self, replica, error):
+        with self._lock:
+            replica.failures += 1
+            duration = self.eject_for * 2 ** min(replica.failures - 1, 3)
+            replica.ejected_until = time.monotonic() + duration
+
+        REPLICA_EJECTIONS.labels(replica.name).inc()
+        logger.warning(f"Ejected read replica {replica.name} for {duration}s: {error!r}")
+
+    def succeeded(self, replica):
+        if replica.failures:
+            with self._lock:
+                replica.failures = 0
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            replica.name: {
+                "ejected": replica.ejected_until > now,
+                "failures": replica.failures,
+                "pool": replica.pool.stats(),
+            }
+            for replica in self.replicas
+        }
+
+
+class _Writes:
+    __slots__ = ("wrote",)
+
+    def __init__(self):
+        self.wrote = False
+
+
+_writes = ContextVar("primary_writes", default=None)
+
+
+@contextmanager
+def read_your_writes():
+    """
+    Sends the reads inside the block (a request) to the primary once
+    something in it was written. Like the query tracker, the state is
+    shared with the tasks and threads the block awaits.
+    """
+    token = _writes.set(_Writes())
+    try:
+        yield
+    finally:
+        _writes.reset(token)
+
+
+def note_write():
+    writes = _writes.get()
+    if writes is not None:
+        writes.wrote = True
+
+
+def reads_from_primary():
+    """
+    Whether the current request already wrote, so it has to read from the
+    primary.
+    """
+    writes = _writes.get()
+    return writes is not None and writes.wrote
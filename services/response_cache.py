@@ -0,0 +1,99 @@
+import hashlib
+import logging
+import os
+
+import orjson
+from fastapi import Response
+from pydantic import BaseModel
+
+from services.cache_backend import get_cache
+
+logger = logging.getLogger(__name__)
+
+# Serialized GET responses per group live in the shared cache backend as
+# "group:<id>:v<version>:<kind>" -> [etag, body]. Bumping the group's
+# version invalidates all of them at once, in every worker. The TTL only
+# bounds staleness if an invalidation is ever missed.
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+
+
+def _version_key(group_id):
+    return f"group:{group_id}:version"
+
+
+def make_etag(body: bytes) -> str:
+    """
+    Returns a strong ETag derived from the response body.
+    """
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Whether an If-None-Match header value matches the ETag. Uses the weak
+    comparison that RFC 9110 prescribes for If-None-Match.
+    """
+    if not if_none_match:
+        return False
+
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+async def cached_group_response(
+    group_id, kind, build, if_none_match=None, include=None
+):
+    """
+    Serves a group's response of the given kind from the cache, building
+    it with `build()` on a miss. `build()` is a coroutine returning a
+    pydantic model, or plain dicts and lists, which are serialized with
+    orjson as they are. `include` limits a model to these fields; partial
+    responses need a kind of their own.
+
+    Returns a 304 Not Modified if the client's If-None-Match already
+    matches the ETag of the current response.
+    """
+    cache = get_cache()
+    version = await cache.get(_version_key(group_id)) or 0
+    key = f"group:{group_id}:v{version}:{kind}"
+
+    cached = await cache.get(key)
+    if cached is None:
+        content = await build()
+        if isinstance(content, BaseModel):
+            body = content.model_dump_json(include=include)
+        else:
+            body = orjson.dumps(content).decode()
+        cached = [make_etag(body.encode()), body]
+        await cache.set(key, cached, RESPONSE_CACHE_TTL)
+
+    etag, body = cached
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def invalidate_group(group_id):
+    """
+    Invalidates every cached response of a group in all workers, call it
+    whenever the group or its members change.
+
+    It runs after the change was committed, so a cache that is down is
+    only logged: failing the request would report a committed change as
+    failed, and a retry would repeat it. RESPONSE_CACHE_TTL bounds how
+    long the old responses stay visible then.
+    """
+    try:
+        await get_cache().incr(_version_key(group_id))
+    except Exception:
+        logger.exception(f"Could not invalidate the cached responses of group {group_id}")
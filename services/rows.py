@@ -0,0 +1,64 @@
+from collections import namedtuple
+from functools import lru_cache
+
+# Row types of the tables SQLMachine reads, so rows are read by column name
+# (group.group_name) instead of by position (group[1]). They are plain
+# namedtuples: no per-row dict, and still unpack and compare like the
+# tuples the driver returns.
+
+Group = namedtuple(
+    "Group", ["group_id", "group_name", "group_photo", "member_count"]
+)
+GroupMember = namedtuple("GroupMember", ["group_id", "user_id"])
+User = namedtuple(
+    "User", ["id", "email", "name", "currency_preference", "profile_pic"]
+)
+Job = namedtuple(
+    "Job",
+    [
+        "job_id",
+        "kind",
+        "status",
+        "payload",
+        "result",
+        "error",
+        "attempts",
+        "created_at",
+        "updated_at",
+        "owner",
+        "lease_until",
+    ],
+)
+Migration = namedtuple("Migration", ["version", "name", "applied_at"])
+
+ROW_TYPES = {
+    ("group_service_db", "groups"): Group,
+    ("group_service_db", "group_members"): GroupMember,
+    ("group_service_db", "jobs"): Job,
+    ("group_service_db", "schema_migrations"): Migration,
+    ("user_service_db", "users"): User,
+}
+
+
+@lru_cache(maxsize=None)
+def row_type(schema, table, columns=None):
+    """
+    The row type of a table, or of a projection of it when `columns` (a
+    tuple of column names) is given, e.g. Group(group_photo=...) for
+    `SELECT group_photo FROM group_service_db.groups`.
+    """
+    full = ROW_TYPES[(schema, table)]
+    if columns is None or columns == full._fields:
+        return full
+
+    return namedtuple(full.__name__, columns)
+
+
+def map_rows(schema, table, columns, rows):
+    """
+    Wraps the tuples returned by the driver in the table's row type.
+    """
+    # row_type is cached, so the columns have to be hashable
+    columns = None if columns is None else tuple(columns)
+    make = row_type(schema, table, columns)._make
+    return [make(row) for row in rows]
@@ -1,112 +1,372 @@
 import pymysql
+import threading
+from contextlib import contextmanager, nullcontext
 from dotenv import load_dotenv
+from functools import partial
 import os
 
+from services.connection_pool import ConnectionPool
+from services.metrics import DB_READS, register_pool, timed_query
+from services.replicas import (
+    CONNECTION_ERRORS,
+    DATABASE_REPLICAS,
+    Replica,
+    ReplicaSet,
+    note_write,
+    reads_from_primary,
+)
+from services.rows import map_rows
+from services.ttl_cache import MISSING, TTLCache
+from services.query_builder import (
+    build_select,
+    build_keyset,
+    build_count,
+    build_insert,
+    build_insert_many,
+    build_delete,
+    build_update,
+)
+
 # Use our .env file to set up the environment variables.
 load_dotenv()
 
+# The process-wide pool shared by every SQLMachine, created on first use,
+# and the pools of the read replicas (see services/replicas.py).
+_pool = None
+_replicas = None
+_pool_lock = threading.Lock()
+
+# Cached results of SQLMachine.count, (schema, table, conditions) -> count.
+# Bounded, since every user asking for a total adds a key.
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", "30"))
+COUNT_CACHE_SIZE = int(os.getenv("COUNT_CACHE_SIZE", "10000"))
+_count_cache = TTLCache(max_size=COUNT_CACHE_SIZE, ttl=COUNT_CACHE_TTL)
+
+
+def get_pool():
+    """
+    Returns the process-wide connection pool, creating it on first use.
+
+    The pool is sized by DATABASE_POOL_SIZE, waits DATABASE_POOL_TIMEOUT
+    seconds for a free connection and recycles connections older than
+    DATABASE_POOL_RECYCLE seconds.
+    """
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(SQLMachine.create_connection, **pool_options())
+                register_pool("sync", _pool)
+    return _pool
+
+
+def pool_options():
+    return {
+        "max_size": int(os.getenv("DATABASE_POOL_SIZE", "10")),
+        "timeout": float(os.getenv("DATABASE_POOL_TIMEOUT", "30")),
+        "recycle": float(os.getenv("DATABASE_POOL_RECYCLE", "3600")),
+    }
+
+
+def get_replica_set():
+    """
+    Returns the read replicas of SQLMachine, each with a pool sized like
+    the primary's, creating them on first use.
+    """
+    global _replicas
+
+    if _replicas is None:
+        with _pool_lock:
+            if _replicas is None:
+                replicas = []
+                for host, port in DATABASE_REPLICAS:
+                    name = f"{host}:{port}"
+                    pool = ConnectionPool(
+                        partial(SQLMachine.create_connection, host, port),
+                        **pool_options(),
+                    )
+                    register_pool(f"sync-replica-{name}", pool)
+                    replicas.append(Replica(name, pool))
+                _replicas = ReplicaSet(replicas)
+    return _replicas
+
+
+def pool_stats():
+    """
+    Returns the stats of the process-wide pool (in use, idle, wait time...).
+    """
+    return get_pool().stats()
+
+
+def keyset_page(rows, limit, before=None):
+    """
+    Trims the rows fetched with a `build_keyset` query to the page and
+    puts them in ascending order.
+    """
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before is not None:
+        rows = rows[::-1]
+
+    return {"results": rows, "has_more": has_more}
+
+
+def count_cache_key(schema, table, data=None):
+    return (schema, table, repr(sorted((data or {}).items())))
+
+
+def cached_count(cache_key):
+    """
+    Returns the cached count for the key, or None if missing/expired.
+    """
+    total_count = _count_cache.get(cache_key)
+    return None if total_count is MISSING else total_count
+
+
+def cache_count(cache_key, total_count):
+    _count_cache.set(cache_key, total_count)
+
+
+def _run(connection, query, values, result):
+    with connection.cursor() as cursor, timed_query(query):
+        cursor.execute(query, values)
+        if result == "all":
+            return cursor.fetchall()
+        if result == "one":
+            return cursor.fetchone()
+        return getattr(cursor, result)
+
 
 class SQLMachine:
-    def create_connection(self):
+    def __init__(self, connection=None, primary=False):
+        # set when the machine runs inside a transaction(), every query
+        # then goes through that one connection
+        self._connection = connection
+        # read from the primary too, for rows that must never be stale
+        self.primary = primary
+
+    @staticmethod
+    def create_connection(host=None, port=None):
         """
         Creates a connection to the SQL database specified by the
-        environment variables.
+        environment variables, or to a read replica at `host`.
 
-        Returns the connection.
+        Returns the connection. Queries should borrow connections from
+        the pool with `connection()` instead of calling this directly.
         """
         connection = pymysql.connect(
-            host=os.getenv("DATABASE_IP"),
-            port=int(os.getenv("DATABASE_PORT")),
+            host=host or os.getenv("DATABASE_IP"),
+            port=port or int(os.getenv("DATABASE_PORT")),
             user=os.getenv("DATABASE_UNAME"),
             passwd=os.getenv("DATABASE_PWORD"),
             autocommit=True,
         )
         return connection
 
-    def select(self, schema, table, data=None):
+    def connection(self):
         """
-        Select everything from a certain table in a schema within
-        the database.
+        Borrows a connection from the shared pool, use as
+        `with self.connection() as connection:`.
+        """
+        if self._connection is not None:
+            return nullcontext(self._connection)
+        return get_pool().connection()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs a block of queries as a single transaction:
+
+            with sql.transaction() as tx:
+                tx.insert(...)
+                tx.insert_many(...)
+
+        The transaction commits when the block exits and is rolled back if
+        it raises. Nested calls join the outer transaction.
         """
+        if self._connection is not None:
+            yield self
+            return
 
-        if data is not None:
-            conditions = [f"{x} = %s" for x in data]
-            conditions = " AND ".join(conditions)
-            query = f"SELECT * FROM {schema}.{table} WHERE {conditions}"
-            values = tuple(data.values())
-        else:
-            # construct our query.
-            query = f"SELECT * FROM {schema}.{table}"
-            values = ()
+        # the pool rolls the connection back if the block raises
+        with self.connection() as connection:
+            connection.begin()
+            yield SQLMachine(connection)
+            connection.commit()
 
-        connection = self.create_connection()
-        with connection.cursor() as cursor:
-            cursor.execute(query, values)
-            result = cursor.fetchall()
+    def execute(self, query, values=(), result="all", read_only=False):
+        """
+        Runs a single statement on a pooled connection.
 
-        connection.close()
+        `result` picks what is returned: "all" rows, "one" row, the
+        "rowcount" or the "lastrowid".
 
-        return result
+        `read_only` statements go to a read replica when there are any,
+        unless the machine is bound to a transaction or the primary, or
+        the request already wrote. Every other statement counts as a
+        write and runs on the primary.
+        """
+        if not read_only:
+            note_write()
+        elif self._uses_replicas():
+            replicas = get_replica_set()
+            replica = replicas.choose()
+            if replica is not None:
+                try:
+                    with replica.pool.connection() as connection:
+                        rows = _run(connection, query, values, result)
+                except CONNECTION_ERRORS as e:
+                    # retried on the primary below
+                    replicas.eject(replica, e)
+                else:
+                    replicas.succeeded(replica)
+                    DB_READS.labels("replica").inc()
+                    return rows
+
+        if read_only:
+            DB_READS.labels("primary").inc()
+        with self.connection() as connection:
+            return _run(connection, query, values, result)
+
+    def _uses_replicas(self):
+        return (
+            bool(DATABASE_REPLICAS)
+            and self._connection is None
+            and not self.primary
+            and not reads_from_primary()
+        )
 
-    def select_paginated(self, schema, table, limit, offset):
+    def select(
+        self,
+        schema,
+        table,
+        data=None,
+        order_by=None,
+        limit=None,
+        offset=None,
+        columns=None,
+    ):
+        """
+        Select rows from a certain table in a schema within the database.
+
+        A list/tuple/set value in `data` matches any of its items
+        (`column IN (...)`), so related rows can be fetched in one query.
+        `order_by`, `limit` and `offset` are applied in the database.
+
+        Only the `columns` given are fetched (every column by default).
+        Rows are returned as the table's row type from services.rows, so
+        columns are read by name, e.g. `row.group_name`.
+        """
+        query, values = build_select(
+            schema, table, data, order_by, limit, offset, columns
+        )
+        if query is None:
+            return []
+
+        return map_rows(
+            schema, table, columns, self.execute(query, values, read_only=True)
+        )
+
+    def select_paginated(self, schema, table, limit, offset, include_count=True):
         """
         Select a limited number of entries from a table in a schema within
         the database.
+
+        The total count is only computed when `include_count` is set, and
+        is then served from a short-lived cache (see `count`).
         """
+        query, values = build_select(schema, table, limit=limit, offset=offset)
+        paginated_results = map_rows(
+            schema, table, None, self.execute(query, values, read_only=True)
+        )
 
-        query = f"SELECT * FROM {schema}.{table} LIMIT %s OFFSET %s"
-        count_query = f"SELECT COUNT(*) FROM {schema}.{table}"
+        total_count = self.count(schema, table) if include_count else None
 
-        connection = self.create_connection()
-        with connection.cursor() as cursor:
-            cursor.execute(query, (limit, offset))
-            paginated_results = cursor.fetchall()
+        return {"results": paginated_results, "total_count": total_count}
 
-            cursor.execute(count_query)
-            total_count = cursor.fetchone()[0]
+    def select_keyset(
+        self,
+        schema,
+        table,
+        key,
+        limit,
+        after=None,
+        before=None,
+        data=None,
+        columns=None,
+    ):
+        """
+        Select up to `limit` rows ordered by the (unique) column `key`,
+        starting right after the key value `after` or ending right before
+        the key value `before`. Unlike OFFSET this never scans the rows
+        of earlier pages.
+
+        Returns the rows in ascending key order together with whether
+        there are more rows past the page in the direction of travel.
+        `columns` projects the rows like in `select`; include `key` in it
+        to build the cursors of the next pages.
+        """
+        query, values = build_keyset(
+            schema, table, key, limit, after, before, data, columns
+        )
+        if query is None:
+            return {"results": [], "has_more": False}
 
-        connection.close()
+        rows = map_rows(
+            schema, table, columns, self.execute(query, values, read_only=True)
+        )
+        return keyset_page(rows, limit, before)
 
-        return {"results": paginated_results, "total_count": total_count}
+    def count(self, schema, table, data=None, cached=True):
+        """
+        Count the rows of a table which meet the conditions.
 
-    def insert(self, schema, table, data):
-        columns = ", ".join(data.keys())
-        placeholders = ", ".join(["%s"] * len(data))
+        Counts are cached for COUNT_CACHE_TTL seconds since a full COUNT(*)
+        on a big table is as expensive as the page query itself.
+        """
+        cache_key = count_cache_key(schema, table, data)
+        if cached:
+            total_count = cached_count(cache_key)
+            if total_count is not None:
+                return total_count
 
-        query = f"INSERT INTO {schema}.{table} ({columns}) VALUES ({placeholders})"
+        query, values = build_count(schema, table, data)
+        if query is None:
+            return 0
 
-        connection = self.create_connection()
+        total_count = self.execute(query, values, result="one", read_only=True)[0]
+        cache_count(cache_key, total_count)
 
-        with connection.cursor() as cursor:
-            cursor.execute(query, tuple(data.values()))
-            id = cursor.lastrowid
+        return total_count
 
-        connection.close()
+    def insert(self, schema, table, data):
+        query, values = build_insert(schema, table, data)
 
-        return id
+        return self.execute(query, values, result="lastrowid")
 
-    def delete(self, schema, table, data=None):
-        """
-        Delete all rows from the table which meet the conditions.
+    def insert_many(self, schema, table, rows):
         """
+        Insert many rows (a list of dicts with the same keys) with a single
+        multi-row INSERT statement.
 
-        if data is not None:
-            conditions = [f"{x} = {data[x]}" for x in data]
-            conditions = " AND ".join(conditions)
-            query = f"DELETE FROM {schema}.{table} WHERE {conditions}"
-        else:
-            # construct our query.
-            query = f"DELETE FROM {schema}.{table}"
-
-        connection = self.create_connection()
+        Returns the number of inserted rows.
+        """
+        if not rows:
+            return 0
+        query, values = build_insert_many(schema, table, rows)
 
-        with connection.cursor() as cursor:
-            cursor.execute(query)
-            result = cursor.rowcount
+        return self.execute(query, values, result="rowcount")
 
-        connection.close()
+    def delete(self, schema, table, data=None):
+        """
+        Delete all rows from the table which meet the conditions.
+        """
+        query, values = build_delete(schema, table, data)
+        if query is None:
+            return 0
 
-        return result
+        return self.execute(query, values, result="rowcount")
 
     def update(self, schema, table, update_data, conditions):
         """
@@ -117,22 +377,9 @@ class SQLMachine:
         :param update_data: A dictionary of columns to update and their new values.
         :param conditions: A dictionary of conditions to match for the update.
         """
-        # Create the SET clause for update_data
-        set_clause = ", ".join([f"{key} = %s" for key in update_data.keys()])
-        # Create the WHERE clause for conditions
-        where_clause = " AND ".join([f"{key} = %s" for key in conditions.keys()])
-
-        query = f"UPDATE {schema}.{table} SET {set_clause} WHERE {where_clause}"
-
-        # Combine the values from update_data and conditions into a single tuple
-        values = tuple(update_data.values()) + tuple(conditions.values())
-
-        connection = self.create_connection()
-
-        with connection.cursor() as cursor:
-            cursor.execute(query, values)
-            rowcount = cursor.rowcount  # Number of rows affected by the update
-
-        connection.close()
+        query, values = build_update(schema, table, update_data, conditions)
+        if query is None:
+            return 0
 
-        return rowcount
+        # Number of rows affected by the update
+        return self.execute(query, values, result="rowcount")
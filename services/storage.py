@@ -0,0 +1,271 @@
+import asyncio
+import contextvars
+import os
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+from services.metrics import timed_storage_call
+
+# GCP Bucket Configuration
+BUCKET_NAME = "cache-me-outside"
+
+# Public objects are served from here, and group photo URIs in the
+# database are stored relative to it.
+PUBLIC_BASE_URL = f"https://storage.googleapis.com/{BUCKET_NAME}"
+
+# Bytes read from storage per chunk when streaming an object.
+CHUNK_SIZE = 256 * 1024
+
+# Uploads are sent in chunks of this size (a multiple of 256 KiB) with a
+# resumable upload, so a large file is never sent in one request.
+UPLOAD_CHUNK_SIZE = int(
+    os.getenv("STORAGE_UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024))
+)
+
+# Threads running blocking storage calls for async routes.
+STORAGE_WORKERS = int(os.getenv("STORAGE_WORKERS", "8"))
+
+
+@dataclass
+class BlobInfo:
+    name: str
+    size: int
+    generation: str  # changes whenever the object's content changes
+    content_type: Optional[str] = None
+
+
+def group_photo_name(group_id) -> str:
+    """
+    The name of a group's photo once the group has been created.
+    """
+    return f"groups/{group_id}_photo.png"
+
+
+def object_name(uri: str) -> str:
+    """
+    Extracts the object name from a public URI of an object.
+    """
+    return uri.split(f"{BUCKET_NAME}/")[-1]
+
+
+class StorageBackend(ABC):
+    """
+    Where group photos live. Every method is blocking, so async routes
+    should call them from a thread.
+    """
+
+    @abstractmethod
+    def stat(self, name) -> Optional[BlobInfo]:
+        """
+        Returns the object's metadata, or None if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_range(
+        self, info: BlobInfo, start=0, end=None, chunk_size=CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        """
+        Yields the bytes start..end (inclusive) of the object described by
+        `info` in chunks of at most `chunk_size` bytes.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def upload(self, name, file, content_type=None) -> str:
+        """
+        Uploads a file object, makes it public and returns its public URI.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def rename(self, name, new_name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, name):
+        raise NotImplementedError
+
+    def public_url(self, name) -> str:
+        return f"{PUBLIC_BASE_URL}/{name}"
+
+
+class GCSStorage(StorageBackend):
+    """
+    Objects in the GCP bucket.
+    """
+
+    def __init__(self, bucket_name=BUCKET_NAME):
+        from google.cloud import storage
+
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+
+    def stat(self, name):
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None
+
+        return BlobInfo(
+            name=name,
+            size=blob.size,
+            generation=str(blob.generation),
+            content_type=blob.content_type,
+        )
+
+    def iter_range(self, info, start=0, end=None, chunk_size=CHUNK_SIZE):
+        end = info.size - 1 if end is None else end
+
+        # pin the generation so a concurrent overwrite can't mix contents
+        blob = self.bucket.blob(info.name, generation=int(info.generation))
+        with blob.open("rb", chunk_size=chunk_size) as reader:
+            reader.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = reader.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def upload(self, name, file, content_type=None):
+        # setting a chunk size makes this a chunked, resumable upload
+        blob = self.bucket.blob(name, chunk_size=UPLOAD_CHUNK_SIZE)
+
+        # Upload the file
+        blob.upload_from_file(file, rewind=True, content_type=content_type)
+
+        # Make the file publicly accessible
+        blob.make_public()
+
+        return blob.public_url
+
+    def rename(self, name, new_name):
+        self.bucket.rename_blob(self.bucket.blob(name), new_name)
+
+    def delete(self, name):
+        self.bucket.delete_blob(name)
+
+
+class LocalStorage(StorageBackend):
+    """
+    Objects as files under a local directory, for development and tests.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _path(self, name):
+        path = os.path.abspath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid object name: {name!r}")
+        return path
+
+    def stat(self, name):
+        try:
+            st = os.stat(self._path(name))
+        except FileNotFoundError:
+            return None
+
+        return BlobInfo(name=name, size=st.st_size, generation=str(st.st_mtime_ns))
+
+    def iter_range(self, info, start=0, end=None, chunk_size=CHUNK_SIZE):
+        end = info.size - 1 if end is None else end
+
+        with open(self._path(info.name), "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def upload(self, name, file, content_type=None):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(file, f, CHUNK_SIZE)
+
+        return self.public_url(name)
+
+    def rename(self, name, new_name):
+        new_path = self._path(new_name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.replace(self._path(name), new_path)
+
+    def delete(self, name):
+        os.remove(self._path(name))
+
+
+# The process-wide storage backend and the threads running its calls, both
+# created on first use.
+_storage = None
+_executor = None
+_lock = threading.Lock()
+
+
+def get_storage() -> StorageBackend:
+    """
+    Returns the shared storage backend: a LocalStorage under STORAGE_ROOT
+    if that is set, otherwise the GCP bucket. The GCS client (credential
+    discovery, HTTP session) is only set up once per process.
+    """
+    global _storage
+
+    if _storage is None:
+        with _lock:
+            if _storage is None:
+                root = os.getenv("STORAGE_ROOT")
+                _storage = LocalStorage(root) if root else GCSStorage()
+    return _storage
+
+
+def _get_executor():
+    global _executor
+
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=STORAGE_WORKERS, thread_name_prefix="storage"
+                )
+    return _executor
+
+
+async def run_in_storage_pool(func, *args):
+    """
+    Runs a blocking storage call in the bounded storage thread pool, so
+    concurrent uploads neither block the event loop nor starve the
+    threadpool used by the rest of the app.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _get_executor(), context.run, timed_storage_call, func, *args
+    )
+
+
+def submit_to_storage_pool(func, *args):
+    """
+    Starts a blocking storage call in the storage thread pool without
+    waiting for it, e.g. to fill a cache in the background.
+    """
+    context = contextvars.copy_context()
+    return _get_executor().submit(context.run, timed_storage_call, func, *args)
+
+
+def shutdown_storage():
+    """
+    Waits for running storage calls and stops the storage threads.
+    """
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
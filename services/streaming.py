@@ -0,0 +1,94 @@
+import os
+
+from fastapi import HTTPException, Response
+from fastapi.responses import StreamingResponse
+
+from services.response_cache import etag_matches
+
+# How long clients and CDNs may reuse a photo before revalidating it.
+PHOTO_MAX_AGE = int(os.getenv("PHOTO_MAX_AGE", "3600"))
+
+
+def parse_range(range_header, size):
+    """
+    Parses a single "bytes=" Range header into an inclusive (start, end).
+
+    Returns None if there is no header or it asks for several ranges (the
+    whole body is served then), and raises ValueError if the range can't
+    be satisfied.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+
+    spec = range_header[len("bytes="):].strip()
+    if "," in spec:
+        return None
+
+    first, _, last = spec.partition("-")
+    try:
+        if not first:
+            # suffix range, the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise ValueError
+            start, end = max(0, size - length), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError:
+        raise ValueError(f"Invalid range: {range_header!r}")
+
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise ValueError(f"Range not satisfiable: {range_header!r}")
+
+    return start, end
+
+
+def ranged_response(size, etag, media_type, iter_range, headers, vary=None):
+    """
+    Streams a body of `size` bytes with `iter_range(start, end)`, honouring
+    the request's If-None-Match, Range and If-Range headers.
+
+    Responds 304 if the client's copy is current, 206 with just the
+    requested bytes for a Range request, and 200 with everything otherwise.
+    `vary` names the request headers the body was negotiated on.
+    """
+    response_headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={PHOTO_MAX_AGE}",
+        "Accept-Ranges": "bytes",
+    }
+    if vary:
+        response_headers["Vary"] = vary
+
+    if etag_matches(headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=response_headers)
+
+    byte_range = None
+    if_range = headers.get("if-range")
+    if size and (not if_range or if_range == etag):
+        try:
+            byte_range = parse_range(headers.get("range"), size)
+        except ValueError:
+            raise HTTPException(
+                status_code=416,
+                detail="Requested range not satisfiable",
+                headers={"Content-Range": f"bytes */{size}"},
+            )
+
+    if byte_range is None:
+        start, end, status_code = 0, size - 1, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        response_headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    response_headers["Content-Length"] = str(end - start + 1)
+
+    return StreamingResponse(
+        iter_range(start, end) if size else iter(()),
+        status_code=status_code,
+        media_type=media_type,
+        headers=response_headers,
+    )
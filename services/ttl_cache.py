@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Returned by TTLCache.get for keys that aren't cached, since None can be a
+# legitimately cached value.
+MISSING = object()
+
+
+class TTLCache:
+    """
+    A bounded, thread-safe LRU cache whose entries expire `ttl` seconds
+    after they were stored.
+
+    Once `max_size` entries are cached, the least recently used entry is
+    evicted to make room for a new one.
+    """
+
+    def __init__(self, max_size=1024, ttl=300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+        # counters for stats()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key, default=MISSING):
+        """
+        Returns the cached value for the key, or `default` if it isn't
+        cached or has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return default
+
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                self._expirations += 1
+                self._misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def get_many(self, keys):
+        """
+        Returns a dict of the cached values for the keys that are cached.
+        """
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not MISSING:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl=None):
+        """
+        Caches a value for `ttl` seconds (defaults to the cache's ttl).
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, key):
+        """
+        Drops a key from the cache. Returns whether it was cached.
+        """
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the cache's size and hit/miss/eviction counters.
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
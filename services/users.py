@@ -0,0 +1,104 @@
+import os
+
+from services.async_sql_comands import AsyncSQLMachine
+from services.cache_backend import get_cache
+from services.rows import User
+
+# Lookups of user_service_db.users rows, cached in the shared cache backend
+# as "user:id:<id>" -> User row and "user:email:<email>" -> id. The rows
+# are read from the primary, a lagging replica's rows would be cached for
+# every worker.
+# TODO: Replace with calls to the user microservice.
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+
+def _id_key(id):
+    return f"user:id:{id}"
+
+
+def _email_key(email):
+    # emails match case-insensitively, like in the users table
+    return f"user:email:{email.casefold()}"
+
+
+async def _remember(rows):
+    entries = {}
+    for user in rows:
+        entries[_id_key(user.id)] = list(user)
+        entries[_email_key(user.email)] = user.id
+    await get_cache().set_many(entries, USER_CACHE_TTL)
+
+
+async def get_users(ids):
+    """
+    Returns a dict of id -> User row for the given ids. Rows missing
+    from the cache are fetched together with a single query; unknown ids
+    are left out of the result.
+    """
+    ids = set(ids)
+    cached = await get_cache().get_many([_id_key(id) for id in ids])
+    users = {
+        id: User(*cached[_id_key(id)]) for id in ids if _id_key(id) in cached
+    }
+
+    missing = ids - users.keys()
+    if missing:
+        sql = AsyncSQLMachine(primary=True)
+        rows = await sql.select("user_service_db", "users", {"id": missing})
+        await _remember(rows)
+        for user in rows:
+            users[user.id] = user
+
+    return users
+
+
+async def get_uids_from_emails(emails):
+    """
+    Returns a dict of email -> user id for the given emails, keyed by the
+    emails as given; they match the users' emails case-insensitively.
+    Emails missing from the cache are resolved together with a single
+    query; unknown emails are left out of the result.
+    """
+    emails = set(emails)
+    cached = await get_cache().get_many([_email_key(email) for email in emails])
+    uids = {
+        email: cached[_email_key(email)]
+        for email in emails
+        if _email_key(email) in cached
+    }
+
+    missing = emails - uids.keys()
+    if missing:
+        sql = AsyncSQLMachine(primary=True)
+        # only the ids are needed, the rest of the row isn't worth fetching
+        rows = await sql.select(
+            "user_service_db", "users", {"email": missing}, columns=("id", "email")
+        )
+        await get_cache().set_many(
+            {_email_key(user.email): user.id for user in rows}, USER_CACHE_TTL
+        )
+        # the table's collation matched them ignoring case, so the rows
+        # may spell them differently
+        found = {user.email.casefold(): user.id for user in rows}
+        for email in missing:
+            if email.casefold() in found:
+                uids[email] = found[email.casefold()]
+
+    return uids
+
+
+async def invalidate_user(id=None, email=None):
+    """
+    Drops a user from the cache, e.g. after their row changed.
+    """
+    keys = []
+    if id is not None:
+        user = await get_cache().get(_id_key(id))
+        keys.append(_id_key(id))
+        if user is not None:
+            keys.append(_email_key(User(*user).email))
+    if email is not None:
+        keys.append(_email_key(email))
+
+    await get_cache().delete(*keys)
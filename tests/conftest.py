@@ -0,0 +1,55 @@
+import os
+import tempfile
+
+# The service reads its configuration at import time, so the environment
+# is set before anything of it is imported. The database is the SQLite
+# stand-in of the benchmarks, see benchmarks/stand_in.py.
+_workdir = tempfile.mkdtemp(prefix="group-service-tests-")
+os.environ["STORAGE_ROOT"] = os.path.join(_workdir, "storage")
+os.environ["PHOTO_CACHE_DIR"] = os.path.join(_workdir, "photo-cache")
+os.environ["MIGRATE_ON_STARTUP"] = "0"
+os.environ["LOG_LEVEL"] = "ERROR"
+os.environ["ACCESS_LOG_SAMPLE_RATE"] = "0"
+# a request over its query budget fails the test
+os.environ["QUERY_BUDGET_STRICT"] = "1"
+os.environ.pop("CACHE_URL", None)
+os.environ.pop("DATABASE_REPLICAS", None)
+
+import httpx
+import pytest
+
+from benchmarks import seed, stand_in
+
+USERS = 50
+GROUPS = 20
+MEMBERS = 5
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+def database():
+    from services.storage import get_storage
+
+    stand_in.install()
+    seed.seed(USERS, GROUPS, MEMBERS, 0, get_storage())
+
+
+@pytest.fixture
+async def client(database):
+    """
+    A client of the app with every cache empty.
+    """
+    import main
+    from services.cache_backend import close_cache
+    from services.sql_comands import _count_cache
+
+    await close_cache()
+    _count_cache.clear()
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+            yield c
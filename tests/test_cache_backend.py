@@ -0,0 +1,91 @@
+import pytest
+import redis.asyncio as redis
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from services import response_cache
+from services.cache_backend import CacheBackend, RedisCacheBackend
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+async def backend(server, monkeypatch):
+    monkeypatch.setattr(
+        redis.Redis,
+        "from_url",
+        lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server),
+    )
+    backend = RedisCacheBackend("redis://localhost:6379/0")
+    yield backend
+    await backend.close()
+
+
+async def test_get_and_set(backend):
+    assert await backend.get("missing") is None
+
+    await backend.set("user:id:1", ["1", "a@example.com"], ttl=30)
+    assert await backend.get("user:id:1") == ["1", "a@example.com"]
+    assert 0 < await backend._client.ttl("group_service:user:id:1") <= 30
+
+    await backend.set_many({"a": 1, "b": {"c": 2}})
+    assert await backend.get_many(["a", "b", "missing"]) == {"a": 1, "b": {"c": 2}}
+    assert await backend._client.ttl("group_service:a") == -1
+
+    assert backend.stats() == {"hits": 3, "misses": 2, "errors": 0}
+
+
+async def test_delete(backend):
+    await backend.set_many({"a": 1, "b": 2})
+    await backend.delete("a", "missing")
+    assert await backend.get_many(["a", "b"]) == {"b": 2}
+
+
+async def test_incr(backend):
+    assert await backend.incr("group:1:version") == 1
+    assert await backend.incr("group:1:version") == 2
+    assert await backend.get("group:1:version") == 2
+
+
+async def test_fails_open(backend, server):
+    await backend.set("a", 1)
+    server.connected = False
+
+    # reads miss and writes are dropped, the callers use the database
+    assert await backend.get("a") is None
+    assert await backend.get_many(["a", "b"]) == {}
+    await backend.set("a", 2)
+    await backend.delete("a")
+    assert backend.stats()["errors"] == 4
+
+    # a lost version bump is the caller's to handle
+    with pytest.raises(redis.ConnectionError):
+        await backend.incr("group:1:version")
+
+
+async def test_invalidation_fails_open(backend, server, monkeypatch):
+    monkeypatch.setattr(response_cache, "get_cache", lambda: backend)
+    server.connected = False
+
+    # logged, the change it follows was committed already
+    await response_cache.invalidate_group(1)
+
+
+def test_incomplete_backend_fails_on_construction():
+    class NoIncr(CacheBackend):
+        async def get_many(self, keys):
+            return {}
+
+        async def set_many(self, mapping, ttl=None):
+            pass
+
+        async def delete(self, *keys):
+            pass
+
+    with pytest.raises(TypeError):
+        NoIncr()
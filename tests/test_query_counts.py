@@ -0,0 +1,73 @@
+import re
+
+import pytest
+
+from services import users
+from services.query_tracker import QueryBudgetExceeded, track_queries
+from tests.conftest import GROUPS, MEMBERS
+
+# The number of database statements of the routes that list groups and
+# members, read from the Server-Timing header the query tracker of every
+# request writes. A route going N+1 (a query per group or per member)
+# shows up here long before it shows up in the latencies.
+
+pytestmark = pytest.mark.anyio
+
+_QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def queries(response):
+    assert response.status_code == 200, response.text
+    return int(_QUERIES.search(response.headers["server-timing"]).group(1))
+
+
+async def test_get_all_groups(client):
+    # the user's memberships, the groups on the page, their members and the
+    # members' users, one query each however many groups are on the page
+    response = await client.get("/groups", params={"user_id": "1", "limit": 10})
+    assert queries(response) == 4
+
+    # the users come from the cache now
+    response = await client.get("/groups", params={"user_id": "1", "limit": 10})
+    assert queries(response) == 3
+
+
+async def test_get_all_groups_total(client):
+    params = {"user_id": "1", "limit": 10, "include_total": "true"}
+    assert queries(await client.get("/groups", params=params)) == 5
+    # the total is cached too
+    assert queries(await client.get("/groups", params=params)) == 3
+
+
+async def test_get_group_members(client):
+    # the group, its members and their users, however many members it has
+    response = await client.get("/groups/1/members")
+    assert len(response.json()["members"]) == MEMBERS
+    assert queries(response) == 3
+
+    # served from the response cache
+    assert queries(await client.get("/groups/1/members")) == 0
+
+
+async def test_batch_get(client):
+    # groups, members and users, one query each for the whole batch
+    response = await client.post(
+        "/groups:batchGet", json={"group_ids": list(range(1, GROUPS + 1))}
+    )
+    assert queries(response) == 3
+
+    response = await client.post("/groups:batchGet", json={"group_ids": [1, 2]})
+    assert queries(response) == 2
+
+
+async def test_users_are_fetched_in_one_query(database):
+    with track_queries(budget=1, strict=True) as tracker:
+        await users.get_users([str(user_id) for user_id in range(1, 11)])
+    assert tracker.count == 1
+
+
+async def test_strict_budget(database):
+    with pytest.raises(QueryBudgetExceeded):
+        with track_queries(budget=1, strict=True):
+            await users.get_users(["11"])
+            await users.get_users(["12"])